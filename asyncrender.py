@@ -0,0 +1,193 @@
+"""
+Asynchronous rendering of DRY documents for asyncio applications.
+Templates of the yj engine are rendered in Jinja2's async mode. include()
+and filevars() read files in the event loop's executor and system() runs
+commands with asyncio subprocesses, so renders running in the same loop
+overlap their I/O instead of blocking the loop. Requires Python 3.5.
+
+Other engines don't do I/O, their documents are rendered synchronously.
+"""
+
+import asyncio
+import functools
+import os
+import sys
+
+import drydoc
+import templatefunctions
+
+_environment = None
+
+
+def _template_class():
+    import yjengine
+
+    class AsyncJinja2Template(yjengine.FixedJinja2Template):
+        async def render_async(self, **kwargs):
+            rendered = await super(AsyncJinja2Template, self).render_async(
+                **kwargs)
+            if self.text.endswith('\n') and not rendered.endswith('\n'):
+                rendered += '\n'
+            return rendered
+
+    return AsyncJinja2Template
+
+
+def get_environment():
+    """Returns the Jinja2 environment shared by all async templates."""
+    global _environment
+    if _environment is None:
+        import yjengine
+        _environment = yjengine.create_environment(
+            template_class=_template_class(), enable_async=True)
+    return _environment
+
+
+def compile_template(text):
+    """Returns template compiled from text for rendering with
+    render_async.
+    """
+    import yjengine
+    return yjengine.compile_template(text, environment=get_environment())
+
+
+def _is_yj(doc):
+    return 'yj' in drydoc.engines and \
+        doc.template_engine is drydoc.engines['yj'][1][0]
+
+
+async def render_doc(doc, env=None):
+    """Renders DryDoc like DryDoc.render, but awaits template functions
+    which return awaitables.
+    """
+    if not _is_yj(doc):
+        return doc.render(env=env)
+
+    sections = doc.sections
+    if not sections.is_dry:
+        return doc.text
+
+    variables = doc.get_variables()
+    if env is not None:
+        variables.update(env)
+
+    t = drydoc.template_cache.get(compile_template, sections.template)
+    rendered = await t.render_async(**variables)
+    return rendered.lstrip('\n')
+
+
+async def render_text(text, filename=None, encoding=drydoc.default_encoding,
+                      variable_cache=None, dependencies=None, options=None,
+                      env=None):
+    """Renders DRY text like drydoc.render_text, without blocking the event
+    loop. Documents are not prerendered with parallel_includes option,
+    includes of different renders overlap instead.
+    Raises drydoc.RenderError with a message which can be shown to user.
+    """
+    options = dict(options or {}, parallel_includes=False)
+    doc, env = drydoc._prepare_render(text, filename, encoding,
+                                      variable_cache, dependencies, None,
+                                      options, env, get_funcs=get_funcs)
+    engine = drydoc.engines[drydoc.default_engine]
+    try:
+        return await render_doc(doc, env=env)
+    except engine[0][1] as e:
+        raise drydoc.RenderError('Error parsing variables: %s' %
+                                 str(e).capitalize())
+    except engine[1][1] as e:
+        raise drydoc.RenderError('Error parsing template: %s' %
+                                 str(e).capitalize())
+
+
+async def run_command(cmd, docdir):
+    """Executes cmd in shell in docdir and returns its output."""
+    PIPE = asyncio.subprocess.PIPE
+    STDOUT = asyncio.subprocess.STDOUT
+    process = await asyncio.create_subprocess_shell(
+        cmd, stdout=PIPE, stderr=STDOUT, stdin=PIPE, cwd=docdir)
+    return (await process.communicate())[0]
+
+
+def _command(cmd, info):
+    """Returns task of cmd executed in directory of the document. Commands
+    are executed once per render, like with templatefunctions.CommandCache.
+    """
+    docdir = info['docdir']
+    tasks = info['command_tasks']
+    key = (cmd, docdir)
+    task = tasks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run_command(cmd, docdir))
+        tasks[key] = task
+    return task
+
+
+async def template_system(cmd, info=None):
+    templatefunctions._mark_volatile(info)
+    return await _command(cmd, info)
+
+
+def template_prefetch(*cmds, **kwargs):
+    """Starts executing cmds in the event loop. Returns empty string."""
+    info = kwargs['info']
+    templatefunctions._mark_volatile(info)
+    for cmd in cmds:
+        _command(cmd, info)
+    return ''
+
+
+async def template_filevars(path, info=None):
+    loop = asyncio.get_event_loop()
+    func = functools.partial(templatefunctions.template_filevars, path,
+                             info=info)
+    return await loop.run_in_executor(None, func)
+
+
+async def template_include(path, render=True, info=None):
+    """Returns document in path like templatefunctions.template_include.
+    File is read through drydoc.file_cache in the event loop's executor.
+    """
+    filepath = os.path.abspath(os.path.join(info['docdir'], path))
+    templatefunctions.add_dependency(filepath, info)
+
+    if render:
+        include_stack = templatefunctions.check_include(filepath, info)
+
+    loop = asyncio.get_event_loop()
+    contents = await loop.run_in_executor(None, drydoc.file_cache.read,
+                                          filepath)
+    if not render:
+        return contents
+    doc = drydoc.DryDoc(contents)
+
+    newinfo = info.copy()
+    newinfo['docdir'] = os.path.split(filepath)[0]
+    newinfo['include_stack'] = include_stack
+
+    # Template renders its function calls one at a time, so the context can
+    # be switched to the included document until it's rendered
+    context = info['context']
+    previous = context.info
+    context.info = newinfo
+    try:
+        return await render_doc(doc, env=info['template_env'])
+    finally:
+        context.info = previous
+
+
+def get_funcs(info):
+    """Returns template functions like templatefunctions.get_funcs, with
+    the asynchronous versions of functions which do I/O.
+    """
+    d = templatefunctions.get_funcs(info)
+    context = info['context']
+    # Included documents get copies of info, the tasks are shared with them
+    info['command_tasks'] = {}
+
+    prefix = templatefunctions.func_prefix
+    for name in dir(sys.modules[__name__]):
+        if name.startswith(prefix):
+            func = globals()[name]
+            d[name[len(prefix):]] = templatefunctions.bind(func, context)
+
+    return d
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+
+"""
+Benchmark for rendering synthetic DRY documents with the example and yj
+engines. Reports documents per second, median and 99th percentile latency
+and peak memory of one render for each document. Documents are generated
+the same way on every run, so results of different runs can be compared.
+
+Usage:
+  render.py [<renders>] [--scenario=<name>]... [--save=<file>]
+            [--compare=<file>] [--threshold=<fraction>]
+  render.py -h | --help
+
+Each document is rendered <renders> times, 50 by default.
+
+Options:
+  -h --help               Show this screen.
+  --scenario=<name>       Run only the named scenario. Can be repeated.
+  --save=<file>           Write the results to a JSON file.
+  --compare=<file>        Print how much slower or faster each document got
+                          compared to results written with --save.
+  --threshold=<fraction>  Exit with status 1 if documents per second of any
+                          document dropped more than fraction, e.g. 0.1,
+                          compared to the --compare results.
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+scriptdir = os.path.split(os.path.realpath(__file__))[0]
+parentdir = os.path.abspath(os.path.join(scriptdir, os.path.pardir))
+sys.path.insert(0, parentdir)
+
+import drydoc
+
+# Timer with the best resolution available
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def small(engine, tmpdir):
+    if engine == 'example':
+        return u'a = 1\nb = 汉语漢\n...\na={{ a }}\nb={{ b }}\n'
+    return u'a: 1\nb: 汉语漢\n...\na={{ a }}\nb={{ b }}\n'
+
+
+def big_header(engine, tmpdir, variables=2000):
+    """Document with many variables and a short template."""
+    if engine == 'example':
+        lines = [u'title%d = Section number %d' % (i, i)
+                 for i in range(variables)]
+    else:
+        lines = []
+        for i in range(variables):
+            lines.append(u'title%d: Section number %d' % (i, i))
+            lines.append(u'items%d: [a%d, b%d, c%d]' % (i, i, i, i))
+    lines.append(u'...')
+    lines.append(u'{{ title0 }} {{ title%d }}' % (variables - 1))
+    return u'\n'.join(lines) + u'\n'
+
+
+def big_template(engine, tmpdir, lines=5000):
+    """Document with a few variables and a long template."""
+    text = [u'name = drydoc' if engine == 'example' else u'name: drydoc',
+            u'...']
+    for i in range(lines):
+        text.append(u'Line %d of {{ name }}, more text after it.' % i)
+    return u'\n'.join(text) + u'\n'
+
+
+def many_placeholders(engine, tmpdir, variables=500, lines=5000):
+    """Document with many variables, which are used all over a long
+    template.
+    """
+    if engine == 'example':
+        text = [u'v%d = value %d' % (i, i) for i in range(variables)]
+    else:
+        text = [u'v%d: value %d' % (i, i) for i in range(variables)]
+    text.append(u'...')
+    for i in range(lines):
+        text.append(u'Line %d has {{ v%d }} and {{ v%d }}.' %
+                    (i, i % variables, i * 7 % variables))
+    return u'\n'.join(text) + u'\n'
+
+
+def include_chain(engine, tmpdir, depth=20):
+    """Document which includes a chain of nested documents."""
+    if engine == 'example':
+        return None
+    for i in range(depth):
+        text = u'level: %d\n...\n{{ level }} {{ include("%d.txt") }}' % \
+            (i, i + 1)
+        drydoc.write_file(text, os.path.join(tmpdir, '%d.txt' % i))
+    drydoc.write_file(u'end', os.path.join(tmpdir, '%d.txt' % depth))
+    return drydoc.read_file(os.path.join(tmpdir, '0.txt'))
+
+
+def many_filevars(engine, tmpdir, files=50, calls=500):
+    """Document which reads variables from other documents many times."""
+    if engine == 'example':
+        return None
+    for i in range(files):
+        text = u'a: %d\nb: value %d\n...\n' % (i, i)
+        drydoc.write_file(text, os.path.join(tmpdir, 'vars%d.txt' % i))
+    lines = [u'...']
+    for i in range(calls):
+        lines.append(u'{{ filevars("vars%d.txt").b }}' % (i % files))
+    return u'\n'.join(lines) + u'\n'
+
+
+scenarios = [small, big_header, big_template, many_placeholders,
+             include_chain, many_filevars]
+
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p / 100.0))]
+
+
+def measure(text, filename, renders):
+    """Renders text and returns dictionary of results. Each render gets its
+    own variable cache, like documents rendered from command line.
+    """
+    # Compile the template before measuring
+    drydoc.render_text(text, filename)
+
+    times = []
+    start = timer()
+    for i in range(renders):
+        render_start = timer()
+        drydoc.render_text(text, filename)
+        times.append(timer() - render_start)
+    total = timer() - start
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        drydoc.render_text(text, filename)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'docs_per_sec': renders / total,
+            'p50_ms': percentile(times, 50) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'peak_kb': None if peak is None else peak / 1024.0}
+
+
+def main():
+    from docopt import docopt
+    arguments = docopt(__doc__, argv=sys.argv[1:], help=True)
+
+    try:
+        renders = int(arguments['<renders>'] or 50)
+    except ValueError:
+        renders = 0
+    if renders < 1:
+        print('Invalid number of renders: %s' % arguments['<renders>'])
+        sys.exit(1)
+
+    names = [s.__name__ for s in scenarios]
+    selected = arguments['--scenario'] or []
+    for name in selected:
+        if name not in names:
+            print('Unknown scenario: %s. Scenarios: %s' %
+                  (name, ', '.join(names)))
+            sys.exit(1)
+
+    threshold = arguments['--threshold']
+    if threshold is not None and arguments['--compare'] is None:
+        print('--threshold needs --compare')
+        sys.exit(1)
+    if threshold is not None:
+        try:
+            threshold = float(threshold)
+        except ValueError:
+            threshold = -1
+        if not 0 <= threshold < 1:
+            print('Invalid threshold: %s' % arguments['--threshold'])
+            sys.exit(1)
+
+    baseline = {}
+    if arguments['--compare']:
+        with open(arguments['--compare']) as f:
+            baseline = json.load(f)
+
+    engines = [name for name in ('example', 'yj') if name in drydoc.engines]
+    default_engine = drydoc.default_engine
+    results = {}
+    regressions = []
+
+    print('%-22s %10s %9s %9s %10s' % ('Document', 'docs/s', 'p50 ms',
+                                       'p99 ms', 'peak kB'))
+    for engine in engines:
+        drydoc.default_engine = engine
+        for scenario in scenarios:
+            name = scenario.__name__
+            if selected and name not in selected:
+                continue
+
+            tmpdir = tempfile.mkdtemp()
+            try:
+                text = scenario(engine, tmpdir)
+                if text is None:
+                    continue
+                result = measure(text, os.path.join(tmpdir, 'doc.txt'),
+                                 renders)
+            finally:
+                shutil.rmtree(tmpdir)
+
+            key = '%s/%s' % (engine, name)
+            results[key] = result
+            peak = result['peak_kb']
+            line = '%-22s %10.1f %9.2f %9.2f %10s' % (
+                key, result['docs_per_sec'], result['p50_ms'],
+                result['p99_ms'], '-' if peak is None else '%.0f' % peak)
+            if key in baseline:
+                ratio = result['docs_per_sec'] / baseline[key]['docs_per_sec']
+                line += '  %5.2fx' % ratio
+                if threshold is not None and ratio < 1 - threshold:
+                    line += '  regression'
+                    regressions.append(key)
+            print(line)
+    drydoc.default_engine = default_engine
+
+    if arguments['--save']:
+        with open(arguments['--save'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if regressions:
+        print('Slower than %s by more than %g: %s' % (
+            arguments['--compare'], threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
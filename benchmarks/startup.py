@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+
+"""
+Startup benchmark for drydoc.py.
+Runs drydoc.py in fresh interpreters and reports the fastest and median
+wall clock times of printing version and rendering a small document.
+
+Usage: python benchmarks/startup.py [<repeat>]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+scriptdir = os.path.split(os.path.realpath(__file__))[0]
+parentdir = os.path.abspath(os.path.join(scriptdir, os.path.pardir))
+drydoc_path = os.path.join(parentdir, 'drydoc.py')
+
+small_doc = u"""
+name: startup
+...
+This is {{ name }}.
+"""
+
+
+def measure(args, repeat):
+    """Returns sorted list of wall clock times of running drydoc.py with
+    args repeat times.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.check_call([sys.executable, drydoc_path] + args,
+                                  stdout=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def report(name, times):
+    print('%-12s min %6.1f ms   median %6.1f ms' %
+          (name, times[0] * 1000, times[len(times) // 2] * 1000))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        docpath = os.path.join(tmpdir, 'small.txt')
+        with open(docpath, 'wb') as f:
+            f.write(small_doc.encode('utf-8'))
+
+        report('--version', measure(['--version'], repeat))
+        report('small doc', measure([docpath], repeat))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
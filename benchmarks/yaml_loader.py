@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+
+"""
+Benchmark for parsing big variable sections with different YAML loaders.
+Compares the loader of the yj engine to the pure Python loaders.
+
+Usage: python benchmarks/yaml_loader.py [<variables>]
+"""
+
+import os
+import sys
+import time
+
+scriptdir = os.path.split(os.path.realpath(__file__))[0]
+parentdir = os.path.abspath(os.path.join(scriptdir, os.path.pardir))
+sys.path.insert(0, parentdir)
+
+import yaml
+import yjengine
+
+
+def big_header(variables):
+    """Returns YAML variable section with given number of variables, mixing
+    strings, numbers, lists and nested dictionaries.
+    """
+    lines = []
+    for i in range(variables):
+        lines.append(u'title%d: Section number %d with unicode 汉语漢' % (i, i))
+        lines.append(u'count%d: %d' % (i, i))
+        lines.append(u'items%d: [a%d, b%d, c%d]' % (i, i, i, i))
+        lines.append(u'nested%d:' % i)
+        lines.append(u'    name: nested %d' % i)
+        lines.append(u'    values:')
+        lines.append(u'        - %d' % i)
+        lines.append(u'        - %d.5' % i)
+    return u'\n'.join(lines)
+
+
+def measure(loader, text, repeat=3):
+    """Returns fastest time of parsing text with loader."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        yaml.load(text, Loader=loader)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    variables = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    text = big_header(variables)
+    print('Variable section: %d variables, %d kB' %
+          (variables * 4, len(text.encode('utf-8')) // 1024))
+
+    loaders = [yaml.Loader, yaml.SafeLoader]
+    if yjengine.YamlLoader not in loaders:
+        loaders.append(yjengine.YamlLoader)
+
+    baseline = None
+    for loader in loaders:
+        elapsed = measure(loader, text)
+        baseline = baseline or elapsed
+        name = loader.__name__
+        if loader is yjengine.YamlLoader:
+            name += ' (yj engine)'
+        print('%-26s %8.1f ms  %5.1fx' % (name, elapsed * 1000,
+                                          baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,21 @@
 
 Usage:
   drydoc.py [<filename>] [--encoding=<encoding>] [--output=<output>]
+            [--watch] [--cache=<dir>] [--bytecode-cache=<dir>]
+            [--parallel-includes] [--max-include-depth=<depth>]
+            [--socket=<address>] [--stats] [--profile=<file>]
+            [--index=<file>]
+  drydoc.py <filename>... --output-dir=<dir> [--encoding=<encoding>]
+            [--jobs=<jobs>] [--watch] [--cache=<dir>]
+            [--bytecode-cache=<dir>] [--parallel-includes]
+            [--max-include-depth=<depth>] [--stats] [--profile=<file>]
+            [--index=<file>]
+  drydoc.py --manifest=<file> [--encoding=<encoding>] [--jobs=<jobs>]
+            [--cache=<dir>] [--bytecode-cache=<dir>] [--parallel-includes]
+            [--max-include-depth=<depth>] [--index=<file>]
+  drydoc.py --build-index=<file> <filename>... [--encoding=<encoding>]
+  drydoc.py --serve [--socket=<address>] [--bytecode-cache=<dir>]
+  drydoc.py --diagnostics [--bytecode-cache=<dir>]
   drydoc.py -h | --help
   drydoc.py --version
 
@@ -11,64 +26,166 @@ Usage:
 Options:
   -h --help                 Show this screen.
   -v --version              Show version.
+  --diagnostics             Show engines and libraries in use.
   -e --encoding=<encoding>  Encoding of the input file.
   -o --output=<output>      Output file.
+  -d --output-dir=<dir>     Render all given files, directories and glob
+                            patterns to directory.
+  -j --jobs=<jobs>          Number of worker processes when rendering to
+                            directory. Defaults to number of CPUs.
+  -m --manifest=<file>      Render documents listed in JSON or YAML
+                            manifest. Documents whose output others read
+                            are rendered first, the rest in parallel.
+  -w --watch                Keep re-rendering documents when they or files
+                            they depend on change.
+  -c --cache=<dir>          Cache rendered documents in directory and skip
+                            rendering when nothing they depend on changed.
+  --bytecode-cache=<dir>    Directory for compiled Jinja2 templates.
+                            Defaults to $DRYDOC_BYTECODE_CACHE or Jinja2's
+                            directory in temp directory.
+  -p --parallel-includes    Render documents included with constant paths
+                            in parallel threads.
+  --max-include-depth=<depth>
+                            Maximum number of nested includes. Defaults to
+                            32.
+  -i --index=<file>         Read variables for filevars() from index built
+                            with --build-index. Documents changed after
+                            building the index are parsed as usual.
+  --build-index=<file>      Build index of variables of given files and
+                            directories, or update the existing index.
+  --serve                   Run render server, which keeps engines and
+                            parsed templates in memory between renders.
+  -s --socket=<address>     Address of render server: path of Unix socket
+                            or localhost:port. Defaults to $DRYDOC_SOCKET, or
+                            drydoc.sock in temp directory for --serve.
+                            Document is rendered in this process if the
+                            server is not running.
+  --stats                   Print time spent reading files, parsing
+                            variables, compiling and rendering templates
+                            and in template functions as a tree of
+                            phases to stderr. Documents are rendered in
+                            this process.
+  --profile=<file>          Write cProfile statistics of the whole run to
+                            file. Worker processes are not profiled, so
+                            use one job to profile batch rendering.
 """
 
+import codecs
+import collections
 import os
 import sys
-import parsers
-import templatefunctions
+import threading
+import time
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2
+    from collections import MutableMapping
 
 __version__ = '0.1.1'
 _PY3 = sys.version_info >= (3, 0)
 
+
+def _module_available(name):
+    """Returns True if module can be imported. The module is not imported."""
+    if _PY3:
+        import importlib.util
+        return importlib.util.find_spec(name) is not None
+
+    import imp
+    try:
+        imp.find_module(name)
+    except ImportError:
+        return False
+    return True
+
+
+class Engines(MutableMapping):
+    """Mapping of engine names to engines, which are loaded on first use.
+    Engines are registered with a loader function, which imports whatever
+    the engine needs and returns the engine. Engine is available, and in
+    the mapping, if all modules listed in its requirements can be imported.
+    Loaded engines can also be set directly, like in a dictionary.
+    """
+
+    def __init__(self):
+        self._loaded = {}
+        self._loaders = {}
+
+    def register(self, name, loader, requires=()):
+        self._loaders[name] = (loader, requires)
+        self._loaded.pop(name, None)
+
+    def available(self):
+        """Returns sorted list of names of engines which can be loaded."""
+        return sorted(self)
+
+    def __contains__(self, name):
+        if name in self._loaded:
+            return True
+        if name not in self._loaders:
+            return False
+        requires = self._loaders[name][1]
+        return all(_module_available(module) for module in requires)
+
+    def __getitem__(self, name):
+        engine = self._loaded.get(name)
+        if engine is not None:
+            return engine
+        if name not in self:
+            raise KeyError(name)
+
+        loader = self._loaders[name][0]
+        with phase('load engine', name):
+            engine = loader()
+        self._loaded[name] = engine
+        return engine
+
+    def __setitem__(self, name, engine):
+        self._loaded[name] = engine
+
+    def __delitem__(self, name):
+        if name not in self._loaded and name not in self._loaders:
+            raise KeyError(name)
+        self._loaded.pop(name, None)
+        self._loaders.pop(name, None)
+
+    def __iter__(self):
+        names = set(self._loaded)
+        names.update(name for name in self._loaders if name in self)
+        return iter(sorted(names))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+def _load_example_engine():
+    import parsers
+    return ((parsers.parse_variables, ()),
+            (parsers.Template, ()))
+
+
+def _load_yj_engine():
+    import yjengine
+    return yjengine.engine
+
+
 # Format: {'enginename': (variable_engine, template_engine)}
 # Variable engine format: (variable_parse_func, (Exception1, Exception2))
 # Template engine format: (TemplateClass, (Exception1, Exception2)
 # Exceptions listed in engines are catched, and nicer errors provided. To
 # format messages even more, make your own exception class and
 # format errors in it.
-engines = {}
+engines = Engines()
 
 # Add example engine
-engines['example'] = ((parsers.parse_variables, ()),
-                      (parsers.Template, ()))
-
-try:
-    import yaml
-    _YAML = True
-except ImportError:
-    _YAML = False
-    pass
-
-try:
-    import jinja2
-    _JINJA2 = True
-
-    # This class fixes the issue when trailing newline is removed, when it
-    # shouldn't be.
-    class FixedJinja2Template(jinja2.Template):
-        def __init__(self, text):
-            super(FixedJinja2Template, self).__init__(text)
-            self.text = text
-
-        def render(self, **kwargs):
-            rendered = super(FixedJinja2Template, self).render(**kwargs)
-            if self.text[-1] == '\n' and rendered[-1] != '\n':
-                rendered += '\n'
-            return rendered
-
-except ImportError:
-    _JINJA2 = False
-    pass
+engines.register('example', _load_example_engine)
 
 # Add yaml-jinja2 engine
-if _YAML and _JINJA2:
-    yaml_engine = (yaml.load, ())
-    jinja_engine = (FixedJinja2Template, ())
-    engines['yj'] = (yaml_engine, jinja_engine)
+engines.register('yj', _load_yj_engine, requires=('yaml', 'jinja2'))
 
+if 'yj' in engines:
     default_engine = 'yj'
 else:
     default_engine = 'example'
@@ -78,6 +195,57 @@ default_encoding = 'utf-8'
 section_separator = '\n...\n'
 # Objects to pass by default to all templates
 template_env = {}
+# Maximum number of compiled templates kept in template_cache
+template_cache_size = 128
+# Maximum total size in bytes of files kept in file_cache
+file_cache_size = 32 * 1024 * 1024
+# Seconds between polls of file changes in watch mode
+watch_interval = 1.0
+# Maximum number of nested include() calls
+max_include_depth = 32
+# Names of options render_text accepts, other options are refused so they
+# can't replace internal state of the render
+render_options = ('docdir', 'max_include_depth', 'parallel_includes',
+                  'variable_index')
+# renderstats.Stats which records time spent in phases of rendering. None
+# disables recording.
+stats = None
+
+
+class RenderError(Exception):
+    """Raised when document can't be rendered. Message is meant to be shown
+    to user as is.
+    """
+
+
+class IncludeError(RenderError):
+    """Raised when documents include each other in a cycle, or includes are
+    nested too deep.
+    """
+
+
+class OutputError(RenderError):
+    """Raised when rendered text can't be written to output file."""
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_phase = _NoPhase()
+
+
+def phase(name, detail=None):
+    """Returns context manager which records time spent in it to stats as
+    phase name. Does nothing if stats is None.
+    """
+    if stats is None:
+        return _no_phase
+    return stats.phase(name, detail)
 
 
 class AttributeDict(dict):
@@ -89,11 +257,218 @@ class AttributeDict(dict):
     __setattr__ = dict.__setitem__
 
 
-class DryDoc(object):
-    def __init__(self, text, engine=engines[default_engine]):
+def hash_text(text):
+    """Returns hex digest of unicode text."""
+    import hashlib
+    errors = 'surrogatepass' if _PY3 else 'strict'
+    return hashlib.sha1(text.encode('utf-8', errors)).hexdigest()
+
+
+class TemplateCache(object):
+    """Size bounded LRU cache for compiled templates.
+    Templates are keyed by template engine and hash of the template source,
+    so the same template section is compiled only once, regardless of which
+    document or include() it came from. Set maxsize to 0 to disable caching.
+    """
+
+    def __init__(self, maxsize=template_cache_size):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get(self, template_engine, text):
+        """Returns compiled template of text. Template is compiled with
+        template_engine if it's not found from cache.
+        """
+        key = (template_engine, hash_text(text))
+        with self._lock:
+            template = self._templates.pop(key, None)
+            if template is not None:
+                # Re-insert to mark as the most recently used
+                self._templates[key] = template
+                self.hits += 1
+                return template
+            self.misses += 1
+
+        with phase('compile'):
+            template = template_engine(text)
+        if self.maxsize > 0:
+            with self._lock:
+                self._templates[key] = template
+                while len(self._templates) > self.maxsize:
+                    self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        """Removes all templates and resets counters."""
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# Compiled templates shared by all documents
+template_cache = TemplateCache()
+
+
+class Sections(object):
+    """Variable and template sections of DRY text.
+    Text is scanned for the section separator once, and only offsets of the
+    sections are stored. Sections are sliced from the text when accessed.
+    If the separator is not found, text is not a DRY document and both
+    sections are None.
+    """
+    __slots__ = ('text', 'variables_end', 'template_start')
+
+    def __init__(self, text):
         self.text = text
+        self.variables_end = None
+        self.template_start = None
+
+        separator = section_separator.lstrip()
+        if text.startswith(separator):
+            self.variables_end = 0
+            self.template_start = len(separator)
+            return
+
+        index = text.find(section_separator)
+        if index != -1:
+            self.variables_end = index
+            self.template_start = index + len(section_separator)
+
+    @property
+    def is_dry(self):
+        return self.template_start is not None
+
+    @property
+    def variables(self):
+        if not self.is_dry:
+            return None
+        return self.text[:self.variables_end]
+
+    @property
+    def template(self):
+        if not self.is_dry:
+            return None
+        return self.text[self.template_start:]
+
+
+def find_separator(data, universal_newlines=_PY3, start=0):
+    """Returns (variables end, template start) offsets of the section
+    separator in bytes-like data, or None if it's not found. With
+    universal_newlines, lines can also end with CR LF or CR, like in files
+    read in text mode. Search starts from offset start.
+    """
+    if not universal_newlines:
+        separator = section_separator.encode('ascii')
+        if start == 0 and data[:len(separator) - 1] == separator[1:]:
+            return 0, len(separator) - 1
+        index = data.find(separator, start)
+        if index == -1:
+            return None
+        return index, index + len(separator)
+
+    while True:
+        index = data.find(b'...', start)
+        if index == -1:
+            return None
+        start = index + 1
+
+        # Dots must be alone on their line
+        if index == 0:
+            variables_end = 0
+        elif data[index - 1:index] == b'\n':
+            variables_end = index - 1
+            if data[index - 2:index - 1] == b'\r':
+                variables_end -= 1
+        elif data[index - 1:index] == b'\r':
+            variables_end = index - 1
+        else:
+            continue
+
+        after = data[index + 3:index + 5]
+        if after == b'\r\n':
+            return variables_end, index + 5
+        if after[:1] in (b'\n', b'\r'):
+            return variables_end, index + 4
+
+
+class MappedSections(object):
+    """Sections of DRY document decoded from a memory mapped file. Separator
+    is searched from the raw bytes and each section is decoded straight
+    from the mapping, so the bytes are never copied. Nothing refers to the
+    mapping afterwards, so the caller can close it right away. Encoding
+    must have the same bytes for the separator as ASCII.
+    """
+
+    def __init__(self, mapping, encoding):
+        self.encoding = encoding
+        self.variables = None
+        self.template = None
+        self.variables_end = None
+        self.template_start = None
+        self._text = None
+
+        offsets = find_separator(mapping)
+        if offsets is None:
+            self._text = self._decode(mapping, 0, len(mapping))
+            return
+        self.variables_end, self.template_start = offsets
+        self.variables = self._decode(mapping, 0, self.variables_end)
+        self._separator = self._decode(mapping, self.variables_end,
+                                       self.template_start)
+        self.template = self._decode(mapping, self.template_start,
+                                     len(mapping))
+
+    def _decode(self, mapping, start, end):
+        if _PY3:
+            # Decode straight from the mapping without copying the bytes
+            with memoryview(mapping) as view:
+                with view[start:end] as data:
+                    text = codecs.decode(data, self.encoding)
+            if '\r' in text:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            return text
+        return mapping[start:end].decode(self.encoding, errors='replace')
+
+    @property
+    def is_dry(self):
+        return self.template_start is not None
+
+    @property
+    def text(self):
+        """Whole text of the document. Joined on every access."""
+        if self.is_dry:
+            return self.variables + self._separator + self.template
+        return self._text
+
+
+class DryDoc(object):
+    def __init__(self, text, engine=None):
+        if engine is None:
+            engine = engines[default_engine]
+        self._text = text
         self.variable_engine = engine[0][0]
         self.template_engine = engine[1][0]
+        self._sections = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            return self._sections.text
+        return self._text
+
+    @property
+    def sections(self):
+        """Sections of the document, parsed on first access."""
+        if self._sections is None:
+            self._sections = Sections(self.text)
+        return self._sections
 
     def get_variables(self):
         return self._parse_variables()
@@ -104,39 +479,66 @@ class DryDoc(object):
         to be sent to template.
         Warning: variables in env dict override the ones in DRY doc.
         """
-        text = self.text
-        text_parts = self._split_text(text)
-        if len(text_parts) != 2:
-            return text
+        sections = self.sections
+        if not sections.is_dry:
+            return self.text
 
-        variables = self.get_variables()
+        with phase('variables'):
+            variables = self.get_variables()
         if env is not None:
             variables.update(env)
 
-        template = text_parts[1]
-
-        t = self.template_engine(template)
-        rendered = t.render(**variables).lstrip('\n')
+        t = template_cache.get(self.template_engine, sections.template)
+        with phase('render'):
+            rendered = t.render(**variables).lstrip('\n')
         return rendered
 
-    def _split_text(self, text):
-        """Splits text to two parts: variable and template sections.
-        It's callers resposibility to check that all parts exist.
+    def render_async(self, env=None):
+        """Returns coroutine which renders like render, but awaits template
+        functions in env which return awaitables. Requires Python 3.5.
         """
-        separator = section_separator
-        if text.startswith(separator.lstrip()):
-            separator = separator.lstrip()
-        text_parts = text.split(separator, 1)
-        return text_parts
+        import asyncrender
+        return asyncrender.render_doc(self, env=env)
+
+    def render_iter(self, env=None):
+        """Renders like render, but yields the rendered text in chunks as
+        template engine produces them. Template engines without generate
+        method produce one chunk.
+        """
+        sections = self.sections
+        if not sections.is_dry:
+            yield self.text
+            return
+
+        with phase('variables'):
+            variables = self.get_variables()
+        if env is not None:
+            variables.update(env)
+
+        t = template_cache.get(self.template_engine, sections.template)
+        if hasattr(t, 'generate'):
+            chunks = t.generate(**variables)
+        else:
+            chunks = [t.render(**variables)]
+
+        # Strip new lines from the beginning, like render does
+        chunks = iter(chunks)
+        for chunk in chunks:
+            chunk = chunk.lstrip('\n')
+            if chunk:
+                yield chunk
+                break
+        for chunk in chunks:
+            yield chunk
 
     def _parse_variables(self):
         """Parses variables from text and returns them in dict format."""
         variables = {}
-        text_parts = self._split_text(self.text)
-        if len(text_parts) != 2:
+        sections = self.sections
+        if not sections.is_dry:
             return variables
 
-        top_section = text_parts[0].strip()
+        top_section = sections.variables.strip()
 
         if len(top_section):
             variables = self.variable_engine(top_section)
@@ -157,8 +559,9 @@ def read_file(filepath, encoding=default_encoding):
     if _PY3:
         open_func = lambda f, mode: open(f, mode, encoding=encoding)
 
-    with open_func(filepath, 'r') as f:
-        content = f.read()
+    with phase('read', filepath):
+        with open_func(filepath, 'r') as f:
+            content = f.read()
 
     if not _PY3:
         content = content.decode(encoding, errors='replace')
@@ -166,16 +569,321 @@ def read_file(filepath, encoding=default_encoding):
     return content
 
 
+# Encodings which have the section separator in the same bytes as ASCII,
+# so documents in them can be split before decoding
+mappable_encodings = ('utf-8', 'ascii', 'iso8859-1', 'iso8859-15', 'cp1252')
+
+
+def _is_mappable(encoding):
+    try:
+        return codecs.lookup(encoding).name in mappable_encodings
+    except LookupError:
+        return False
+
+
+def read_document(filepath, encoding=default_encoding, engine=None):
+    """Returns DryDoc of file. Files in mappable_encodings are memory mapped
+    and the sections are decoded straight from the mapping, so a big
+    document is held in memory about once, instead of as bytes, text and
+    sliced template. The file is unmapped before returning.
+    """
+    sections = None
+    if _is_mappable(encoding):
+        import mmap
+        with phase('read', filepath):
+            with open(filepath, 'rb') as f:
+                try:
+                    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    # Empty files and e.g. pipes can't be mapped
+                    mapping = None
+                if mapping is not None:
+                    try:
+                        sections = MappedSections(mapping, encoding)
+                    finally:
+                        mapping.close()
+
+    if sections is None:
+        return DryDoc(read_file(filepath, encoding=encoding), engine=engine)
+
+    doc = DryDoc(None, engine=engine)
+    doc._sections = sections
+    return doc
+
+
+def is_plain_file(filepath, encoding=default_encoding):
+    """Returns True if file is not a DRY document and rendering it would
+    output the same bytes, so it can be copied without decoding. Files with
+    CR characters are not plain, because reading converts line endings.
+    """
+    if not _is_mappable(encoding) or os.linesep != '\n':
+        return False
+
+    import mmap
+    with phase('scan', filepath):
+        with open(filepath, 'rb') as f:
+            try:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                return False
+        try:
+            return find_separator(mapping) is None and \
+                mapping.find(b'\r') == -1
+        finally:
+            mapping.close()
+
+
+def copy_file(filepath, output=None):
+    """Copies bytes of file to output file, or to stdout if output is None.
+    Data is copied with os.sendfile where possible, without passing through
+    Python.
+    """
+    import shutil
+    with phase('copy', filepath):
+        if output is not None:
+            # Uses sendfile or similar when available
+            def copy(tmppath):
+                try:
+                    shutil.copyfile(filepath, tmppath)
+                except (IOError, OSError) as e:
+                    raise OutputError('Could not open file. %s' % e)
+            _atomic_write(output, copy)
+            return
+
+        sys.stdout.flush()
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        with open(filepath, 'rb') as f:
+            if _sendfile(f, out):
+                return
+            shutil.copyfileobj(f, out)
+        out.flush()
+
+
+def _sendfile(f, out):
+    """Sends file f to out with os.sendfile. Returns False if sendfile
+    can't be used, before anything is sent.
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None:
+        return False
+    try:
+        out.flush()
+        outfd = out.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+
+    infd = f.fileno()
+    size = os.fstat(infd).st_size
+    offset = 0
+    while offset < size:
+        try:
+            sent = sendfile(outfd, infd, offset, size - offset)
+        except OSError:
+            if offset == 0:
+                # E.g. output is a file type sendfile doesn't support
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    return True
+
+
+def read_variables(filepath, encoding=default_encoding, engine=None):
+    """Returns variables of DRY document in file as AttributeDict, or empty
+    dict if file is not a DRY document. Files in mappable_encodings are read
+    in chunks only until the section separator, and only the variable
+    section is decoded. The template is never read, unless the separator
+    is in the same chunk.
+    """
+    if not _is_mappable(encoding):
+        doc = DryDoc(read_file(filepath, encoding=encoding), engine=engine)
+        return doc.get_variables()
+
+    data = bytearray()
+    offsets = None
+    with phase('read', filepath):
+        with open(filepath, 'rb') as f:
+            while offsets is None:
+                chunk = f.read(8192)
+                if not chunk:
+                    break
+                # Separator can be split between chunks
+                start = max(0, len(data) - 4)
+                data.extend(chunk)
+                offsets = find_separator(data, start=start)
+
+    if offsets is None:
+        return AttributeDict()
+
+    variables = data[:offsets[0]].decode(encoding, 'strict' if _PY3
+                                         else 'replace')
+    if _PY3 and '\r' in variables:
+        variables = variables.replace('\r\n', '\n').replace('\r', '\n')
+    doc = DryDoc(variables + section_separator, engine=engine)
+    return doc.get_variables()
+
+
+def file_fingerprint(filepath):
+    """Returns (modification time, size) tuple of file. Fingerprint changes
+    when file is modified.
+    """
+    st = os.stat(filepath)
+    return (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+
+
+class FileCache(object):
+    """LRU cache for contents of files read by template functions.
+    Contents are keyed by absolute path and encoding, and used as long as
+    the file's fingerprint stays the same. Total size of the cached files
+    is bounded by maxsize bytes, files bigger than that are not cached.
+    """
+
+    def __init__(self, maxsize=file_cache_size):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def read(self, filepath, encoding=default_encoding):
+        """Returns contents of file like read_file."""
+        try:
+            fingerprint = file_fingerprint(filepath)
+        except OSError:
+            # Let read_file raise the usual error
+            return read_file(filepath, encoding=encoding)
+
+        key = (os.path.abspath(filepath), encoding)
+        with self._lock:
+            entry = self._files.pop(key, None)
+            if entry is not None:
+                if entry[0] == fingerprint:
+                    # Re-insert to mark as the most recently used
+                    self._files[key] = entry
+                    self.hits += 1
+                    return entry[1]
+                self.size -= entry[0][1]
+            self.misses += 1
+
+        content = read_file(filepath, encoding=encoding)
+        size = fingerprint[1]
+        if size <= self.maxsize:
+            with self._lock:
+                old = self._files.pop(key, None)
+                if old is not None:
+                    self.size -= old[0][1]
+                self._files[key] = (fingerprint, content)
+                self.size += size
+                while self.size > self.maxsize:
+                    evicted = self._files.popitem(last=False)[1]
+                    self.size -= evicted[0][1]
+        return content
+
+    def clear(self):
+        """Removes all files and resets counters."""
+        with self._lock:
+            self._files.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+
+# Files read by include() and filevars(), shared by all renders in the
+# process
+file_cache = FileCache()
+
+
 def write_file(text, filepath, encoding=default_encoding):
     """Writes unicode to file with specified encoding."""
-    open_func = open
-    if _PY3:
-        open_func = lambda f, mode: open(f, mode, encoding=encoding)
-    else:
-        text = text.encode(encoding, errors='replace')
+    write_chunks([text], filepath, encoding=encoding)
+
+
+def write_chunks(chunks, filepath, encoding=default_encoding):
+    """Writes iterable of unicode chunks to file with specified encoding.
+    Chunks are written as they are produced, to a temporary file which
+    replaces filepath when all chunks are written. If producing the chunks
+    fails, the error is raised as is and filepath is left untouched.
+    Raises OutputError if the file can't be written.
+    """
+    import io
+
+    def write(path):
+        try:
+            f = io.open(path, 'w' if _PY3 else 'wb',
+                        encoding=encoding if _PY3 else None)
+        except (IOError, OSError) as e:
+            raise OutputError('Could not open file. %s' % e)
+        with f:
+            for chunk in chunks:
+                if not _PY3:
+                    chunk = chunk.encode(encoding, errors='replace')
+                try:
+                    f.write(chunk)
+                except (IOError, OSError) as e:
+                    raise OutputError('Could not write file. %s' % e)
+            try:
+                f.flush()
+            except (IOError, OSError) as e:
+                raise OutputError('Could not write file. %s' % e)
 
-    with open_func(filepath, 'w') as f:
-        f.write(text)
+    _atomic_write(filepath, write)
+
+
+def _atomic_write(filepath, write):
+    """Calls write with path of a temporary file in the same directory as
+    filepath, and replaces filepath with the temporary file if write
+    returns. Symbolic links, such as /dev/stdout, and other files which
+    aren't regular files are written directly, so that whatever they point
+    to gets the output. Raises OutputError if filepath can't be replaced.
+    """
+    import tempfile
+
+    if os.path.islink(filepath) or (os.path.exists(filepath) and
+                                    not os.path.isfile(filepath)):
+        write(filepath)
+        return
+
+    directory, name = os.path.split(os.path.abspath(filepath))
+    try:
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix='.%s.' % name,
+                                       suffix='.tmp')
+        os.close(fd)
+    except (IOError, OSError) as e:
+        # Report the output file instead of the temporary one
+        raise OutputError('Could not open file. [Errno %s] %s: %r' %
+                          (e.errno, e.strerror, filepath))
+
+    try:
+        write(tmppath)
+        try:
+            # Temporary files are private, give the usual permissions
+            os.chmod(tmppath, _file_mode(filepath))
+            if os.name == 'nt' and os.path.exists(filepath):
+                os.remove(filepath)
+            os.rename(tmppath, filepath)
+        except (IOError, OSError) as e:
+            raise OutputError('Could not write file. %s' % e)
+    except BaseException:
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+def _file_mode(filepath):
+    """Returns permission bits of filepath, or the ones a new file gets."""
+    try:
+        return os.stat(filepath).st_mode & 0o7777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
 
 
 def inputfile_dir(filename):
@@ -185,75 +893,700 @@ def inputfile_dir(filename):
     return inputfile_dir
 
 
-def main():
-    from docopt import docopt
-    arguments = docopt(__doc__, argv=sys.argv[1:],
-                       help=True, version=__version__)
+def engine_version():
+    """Returns string which identifies versions of drydoc and the default
+    engine. Cached renders are invalidated when it changes.
+    """
+    version = 'drydoc %s, engine %s' % (__version__, default_engine)
+    if default_engine == 'yj':
+        import yjengine
+        version += ', ' + yjengine.version()
+    return version
 
-    encoding = arguments['--encoding']
-    if encoding is None:
-        encoding = default_encoding
 
-    # Read drydoc in from whatever source
+class Dependencies(set):
+    """Set of absolute paths of files read during a render. volatile is
+    True if the rendered text also depends on something which can't be
+    tracked, for example output of system().
+    If hashes is True, hashes of the files are recorded to hashes dict when
+    they are added, before template functions read them. A file changed
+    during the render then doesn't match its hash in the render cache.
+    """
+    volatile = False
+
+    def __init__(self, paths=(), hashes=False):
+        super(Dependencies, self).__init__(paths)
+        self.hashes = {} if hashes else None
+
+    def add(self, path):
+        if self.hashes is not None and path not in self.hashes:
+            import rendercache
+            self.hashes[path] = rendercache.hash_file(path)
+        super(Dependencies, self).add(path)
 
-    filename = arguments['<filename>']
-    if filename is not None:
+
+def render_text(text, filename=None, encoding=default_encoding,
+                variable_cache=None, dependencies=None, cache=None,
+                system_cache=None, options=None, env=None):
+    """Renders DRY text with the default engine and template functions.
+    text can also be a DryDoc, such as one returned by read_document.
+    filename is where the text came from, template functions resolve
+    relative paths from its directory. If filename is None, current working
+    directory is used.
+    variable_cache is a dictionary where variables parsed by filevars() are
+    kept. Pass the same dictionary to several renders to share parsed
+    variables between them, by default each render gets its own cache.
+    If dependencies set is given, absolute paths of all files read with
+    include() and filevars() during the render are added to it.
+    cache is a rendercache.RenderCache. If given, rendered text is taken
+    from it when nothing the document depends on has changed, and stored to
+    it after rendering. Documents read from stdin are not cached.
+    system_cache is a templatefunctions.CommandCache for outputs of system()
+    commands. Pass the same cache to several renders to share outputs
+    between them, by default each render gets its own cache.
+    options is a dictionary of settings for template functions, which is
+    added to info of the document. For example {'parallel_includes': True}
+    renders documents included with constant paths in parallel. Names of
+    options are listed in render_options, others raise RenderError.
+    env is a dictionary of variables which override the ones in the
+    document.
+    Raises RenderError with a message which can be shown to user as is.
+    """
+    with phase('document', '<stdin>' if filename is None else filename):
+        return _render_cached(text, filename, encoding, variable_cache,
+                              dependencies, cache, system_cache, options, env)
+
+
+def _render_cached(text, filename, encoding, variable_cache, dependencies,
+                   cache, system_cache, options, env):
+    """Renders text using cache, see render_text."""
+    text_hash = None
+    if cache is not None and filename is not None and not env:
+        text_hash = hash_text(text.text if isinstance(text, DryDoc) else text)
+        with phase('cache'):
+            cached = cache.get(filename, text_hash, encoding)
+        if cached is not None:
+            rendered_text, paths = cached
+            if dependencies is not None:
+                dependencies.update(paths)
+            return rendered_text
+
+    deps = Dependencies(hashes=text_hash is not None)
+    try:
+        rendered_text = _render_text(text, filename, encoding,
+                                     variable_cache, deps, system_cache,
+                                     options, env)
+    finally:
+        if dependencies is not None:
+            dependencies.update(deps)
+
+    if text_hash is not None and not deps.volatile:
         try:
-            text = read_file(filename)
-        except IOError as e:
-            print('Could not open file. %s' % e)
-            sys.exit(1)
-    else:
-        # This makes it possible to use via pipe e.g. x | python drydoc.py
-        text = sys.stdin.read()
+            cache.put(filename, text_hash, encoding, rendered_text, deps)
+        except (IOError, OSError):
+            # Cache is only an optimization, rendering still succeeded
+            pass
 
-    # Parse and render the drydoc
+    return rendered_text
+
+
+def render_text_iter(text, filename=None, encoding=default_encoding,
+                     variable_cache=None, dependencies=None,
+                     system_cache=None, options=None, env=None):
+    """Renders DRY text like render_text, but yields rendered text in chunks
+    instead of building the whole string. Rendering happens while the chunks
+    are consumed, so RenderError can be raised during iteration.
+    """
+    doc, env = _prepare_render(text, filename, encoding, variable_cache,
+                               dependencies, system_cache, options, env)
+    engine = engines[default_engine]
+    try:
+        for chunk in doc.render_iter(env=env):
+            yield chunk
+    except engine[0][1] as e:
+        raise RenderError('Error parsing variables: %s' %
+                          str(e).capitalize())
+    except engine[1][1] as e:
+        raise RenderError('Error parsing template: %s' % str(e).capitalize())
+
+
+def render_text_async(text, filename=None, encoding=default_encoding,
+                      variable_cache=None, dependencies=None, options=None,
+                      env=None):
+    """Returns coroutine which renders DRY text like render_text, without
+    blocking the event loop on files and commands used by template
+    functions. Requires Python 3.5.
+    """
+    import asyncrender
+    return asyncrender.render_text(text, filename, encoding=encoding,
+                                   variable_cache=variable_cache,
+                                   dependencies=dependencies,
+                                   options=options, env=env)
+
+
+def _render_text(text, filename, encoding, variable_cache, dependencies,
+                 system_cache, options, env=None):
+    """Renders text without cache, see render_text."""
+    doc, env = _prepare_render(text, filename, encoding, variable_cache,
+                               dependencies, system_cache, options, env)
+    engine = engines[default_engine]
+    try:
+        return doc.render(env=env)
+    except engine[0][1] as e:
+        raise RenderError('Error parsing variables: %s' %
+                          str(e).capitalize())
+    except engine[1][1] as e:
+        raise RenderError('Error parsing template: %s' % str(e).capitalize())
+
+
+def _prepare_render(text, filename, encoding, variable_cache, dependencies,
+                    system_cache, options, variables=None, get_funcs=None):
+    """Returns (DryDoc, env) tuple for rendering text with the default
+    engine and template functions. variables override the ones in the
+    document. get_funcs returns the template functions of the render,
+    templatefunctions.get_funcs by default.
+    """
+    unknown = sorted(set(options or ()) - set(render_options))
+    if unknown:
+        raise RenderError('Unknown options: %s' % ', '.join(unknown))
+
+    # Each document gets its own copy of the default objects, so documents
+    # rendered in the same process don't see each other's functions.
+    env = dict(template_env)
+    if variables:
+        env.update(variables)
+    doc = text
+    if not isinstance(doc, DryDoc):
+        doc = DryDoc(text, engine=engines[default_engine])
 
     if default_engine == 'yj':
+        import templatefunctions
+
         # Add functions for jinja2 templates
         if filename is None:
             docdir = os.getcwd()
         else:
             docdir = inputfile_dir(filename)
 
+        if filename is None:
+            include_stack = ('<stdin>',)
+        else:
+            include_stack = (os.path.abspath(filename),)
+
         info = {'docdir': docdir, 'encoding': encoding,
                 'engine': engines[default_engine],
                 'inputfile': filename,
-                'template_env': template_env}
+                'include_stack': include_stack,
+                'max_include_depth': max_include_depth,
+                'template_env': env,
+                'variable_cache': {} if variable_cache is None
+                else variable_cache,
+                # Copies of variables returned by filevars() in this render
+                'render_variables': {},
+                'dependencies': dependencies,
+                'system_cache': templatefunctions.CommandCache()
+                if system_cache is None else system_cache}
+        if options is not None:
+            info.update(options)
 
         # Add template functions to environment
-        funcs = templatefunctions.get_funcs(info)
+        if get_funcs is None:
+            get_funcs = templatefunctions.get_funcs
+        funcs = get_funcs(info)
         info['template_funcs'] = funcs
-        template_env.update(funcs)
+        env.update(funcs)
 
-    engine = engines[default_engine]
-    doc = DryDoc(text)
+        if info.get('parallel_includes'):
+            templatefunctions.prerender_includes(doc, info)
+
+    return doc, env
+
+
+def render_file(filename, output, encoding=default_encoding,
+                variable_cache=None, dependencies=None, cache=None,
+                options=None):
+    """Renders DRY document in filename and writes it to output. Missing
+    directories of output are created. See render_text for variable_cache,
+    dependencies, cache and options. Files which are not DRY documents are
+    copied as is.
+    """
     try:
-        rendered_text = doc.render(env=template_env)
-    except engine[0][1] as e:
-        print('Error parsing variables: %s' % str(e).capitalize())
-        sys.exit(1)
-    except engine[1][1] as e:
-        print('Error parsing template: %s' % str(e).capitalize())
-        sys.exit(1)
+        plain = is_plain_file(filename, encoding=encoding)
+        if not plain:
+            doc = read_document(filename, encoding=encoding)
+    except IOError as e:
+        raise RenderError('Could not open file. %s' % e)
 
-    # Output the rendered text to where ever
+    if not plain:
+        rendered_text = render_text(doc, filename, encoding=encoding,
+                                    variable_cache=variable_cache,
+                                    dependencies=dependencies, cache=cache,
+                                    options=options)
 
-    output = arguments['--output']
-    if output is not None:
-        try:
+    outdir = os.path.dirname(output)
+    try:
+        if outdir and not os.path.isdir(outdir):
+            os.makedirs(outdir)
+    except OSError:
+        # Another worker might have created the directory meanwhile
+        if not os.path.isdir(outdir):
+            raise RenderError('Could not create directory %s' % outdir)
+
+    try:
+        if plain:
+            copy_file(filename, output)
+        else:
             write_file(rendered_text, output, encoding=encoding)
-        except IOError as e:
-            print('Could not open file. %s' % e)
-            sys.exit(1)
+    except IOError as e:
+        raise RenderError('Could not open file. %s' % e)
+
+
+def batch_files(paths, output_dir):
+    """Returns list of (inputfile, outputfile) tuples for batch rendering.
+    paths can contain files, directories and glob patterns. Files are
+    written directly to output_dir, directories are walked recursively and
+    their structure is mirrored in output_dir. Hidden files are skipped.
+    Raises RenderError if different files would be written to the same
+    output file.
+    """
+    import glob
+
+    abs_output_dir = os.path.abspath(output_dir)
+    files = []
+    for path in paths:
+        if os.path.exists(path):
+            matches = [path]
+        else:
+            # Unmatched pattern is kept, so it's reported as missing file
+            matches = sorted(glob.glob(path)) or [path]
+
+        for match in matches:
+            if not os.path.isdir(match):
+                name = os.path.basename(match)
+                files.append((match, os.path.join(output_dir, name)))
+                continue
+
+            for root, dirs, names in os.walk(match):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.') and
+                                 os.path.abspath(os.path.join(root, d)) !=
+                                 abs_output_dir)
+                for name in sorted(names):
+                    if name.startswith('.'):
+                        continue
+                    filepath = os.path.join(root, name)
+                    relpath = os.path.relpath(filepath, match)
+                    files.append((filepath, os.path.join(output_dir, relpath)))
+
+    # Same file can be matched many times, but different files must not
+    # overwrite each other's output
+    unique = []
+    inputs = {}
+    for inputfile, outputfile in files:
+        key = os.path.normcase(os.path.abspath(outputfile))
+        if key in inputs:
+            if os.path.abspath(inputs[key]) != os.path.abspath(inputfile):
+                raise RenderError('%s and %s would both be written to %s' %
+                                  (inputs[key], inputfile, outputfile))
+            continue
+        inputs[key] = inputfile
+        unique.append((inputfile, outputfile))
+    return unique
+
+
+# Variables parsed by filevars() shared by all documents rendered in
+# the same batch process
+_batch_variable_cache = {}
+
+
+def _render_job(job):
+    """Renders one batch job. Returns (error message, dependencies) tuple,
+    error message is None if rendering succeeded. Runs in a worker process,
+    so all errors are catched to keep the rest of the batch going.
+    """
+    filename, output, encoding, cache, options = job
+    dependencies = set()
+    try:
+        render_file(filename, output, encoding=encoding,
+                    variable_cache=_batch_variable_cache,
+                    dependencies=dependencies, cache=cache, options=options)
+    except RenderError as e:
+        return str(e), dependencies
+    except Exception as e:
+        return '%s: %s' % (e.__class__.__name__, e), dependencies
+    return None, dependencies
+
+
+def render_files(files, encoding=default_encoding, jobs=None,
+                 dependencies=None, cache=None, options=None):
+    """Renders list of (inputfile, outputfile) tuples in a pool of jobs
+    worker processes. If jobs is None, number of CPUs is used. With one job,
+    documents are rendered in this process.
+    If dependencies dict is given, it's updated with inputfile: set of files
+    the document depends on. See render_text for cache and options.
+    Returns list of (inputfile, error message) tuples for documents which
+    failed to render.
+    """
+    tasks = [(filename, output, encoding, cache, options)
+             for filename, output in files]
+    if jobs == 1 or len(tasks) < 2:
+        results = [_render_job(task) for task in tasks]
     else:
-        if _PY3:
-            sys.stdout.write(rendered_text)
+        import multiprocessing
+        from concurrent import futures
+        workers = jobs or multiprocessing.cpu_count()
+        # Send documents in chunks to cut down interprocess communication
+        chunksize = max(1, len(tasks) // (workers * 4))
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_render_job, tasks,
+                                        chunksize=chunksize))
+
+    errors = []
+    for (filename, output), (error, deps) in zip(files, results):
+        if error is not None:
+            errors.append((filename, error))
+        if dependencies is not None:
+            dependencies[filename] = deps
+    return errors
+
+
+def _fingerprints(paths):
+    """Returns dict of path: fingerprint. Fingerprint of missing file is
+    None.
+    """
+    fingerprints = {}
+    for path in paths:
+        try:
+            fingerprints[path] = file_fingerprint(path)
+        except OSError:
+            fingerprints[path] = None
+    return fingerprints
+
+
+def watch(paths, output_dir=None, output=None, encoding=default_encoding,
+          jobs=None, interval=None, cache=None, options=None):
+    """Renders documents and keeps re-rendering them when they, or files
+    they include() or read with filevars() change. paths and output_dir are
+    handled like in batch_files. Alternatively single document can be
+    rendered to output file. Files are polled every interval seconds until
+    interrupted, watch_interval is used by default.
+    """
+    if interval is None:
+        interval = watch_interval
+
+    def expand():
+        if output_dir is None:
+            return [(paths[0], output)]
+        return batch_files(paths, output_dir)
+
+    def render(files):
+        errors = render_files(files, encoding=encoding, jobs=jobs,
+                              dependencies=dependencies, cache=cache,
+                              options=options)
+        failed = set(filename for filename, message in errors)
+        for filename, message in errors:
+            print('%s: %s' % (filename, message))
+        for filename, outputfile in files:
+            if filename not in failed:
+                print('Rendered %s' % outputfile)
+        sys.stdout.flush()
+
+    def dependants():
+        """Returns reverse dependency graph: path: set of inputfiles."""
+        graph = {}
+        for filename, outputfile in files:
+            graph.setdefault(os.path.abspath(filename), set()).add(filename)
+            for path in dependencies.get(filename, ()):
+                graph.setdefault(path, set()).add(filename)
+        return graph
+
+    dependencies = {}
+    files = expand()
+    render(files)
+    graph = dependants()
+    fingerprints = _fingerprints(graph)
+
+    while True:
+        time.sleep(interval)
+
+        # New documents may appear in watched directories
+        try:
+            new_files = [f for f in expand() if f not in files]
+        except RenderError as e:
+            print(e)
+            new_files = []
+        files.extend(new_files)
+
+        new_fingerprints = _fingerprints(graph)
+        affected = set()
+        for path, fingerprint in new_fingerprints.items():
+            if fingerprint != fingerprints.get(path):
+                affected.update(graph[path])
+
+        outdated = [f for f in files if f[0] in affected] + new_files
+        if outdated:
+            render(outdated)
+            graph = dependants()
+            # Files which appeared in the graph are fingerprinted as they
+            # were before this render, so changes made meanwhile are noticed
+            new_fingerprints.update(_fingerprints(
+                set(graph) - set(new_fingerprints)))
+        fingerprints = new_fingerprints
+
+
+def diagnostics():
+    """Returns list of lines describing drydoc's setup, for example which
+    engines are available and how they are configured.
+    """
+    names = [name + (' (default)' if name == default_engine else '')
+             for name in engines.available()]
+    lines = ['drydoc %s' % __version__,
+             'Python %s' % sys.version.split()[0],
+             'Engines: %s' % ', '.join(names)]
+
+    if default_engine == 'yj':
+        import yjengine
+        lines.extend(yjengine.diagnostics())
+    return lines
+
+
+def _render_cache(directory):
+    """Returns RenderCache in directory, or None if directory is None."""
+    if directory is None:
+        return None
+    import rendercache
+    return rendercache.RenderCache(directory, engine_version())
+
+
+def main():
+    from docopt import docopt
+    arguments = docopt(__doc__, argv=sys.argv[1:],
+                       help=True, version=__version__)
+
+    if arguments['--profile'] is None:
+        return _main(arguments)
+
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        _main(arguments)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(arguments['--profile'])
+
+
+def _main(arguments):
+    global stats
+    if arguments['--stats']:
+        import renderstats
+        stats = renderstats.Stats()
+        try:
+            _run(arguments)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.write('\n'.join(stats.format()) + '\n')
+            stats = None
+    else:
+        _run(arguments)
+
+
+def _run(arguments):
+    options = {'parallel_includes': arguments['--parallel-includes']}
+
+    depth = arguments['--max-include-depth']
+    if depth is not None:
+        try:
+            depth = int(depth)
+        except ValueError:
+            depth = 0
+        if depth < 1:
+            print('Invalid include depth: %s' %
+                  arguments['--max-include-depth'])
+            sys.exit(1)
+        options['max_include_depth'] = depth
+
+    if arguments['--bytecode-cache'] is not None:
+        # Set in environment, so worker processes use the same directory
+        os.environ['DRYDOC_BYTECODE_CACHE'] = arguments['--bytecode-cache']
+
+    if arguments['--diagnostics']:
+        print('\n'.join(diagnostics()))
+        return
+
+    if arguments['--index'] is not None:
+        # Absolute path, so the server and worker processes find it too
+        options['variable_index'] = os.path.abspath(arguments['--index'])
+
+    if arguments['--serve']:
+        import socket
+        import server
+        address = arguments['--socket'] or server.default_address(True)
+        try:
+            server.serve(address)
+        except (ValueError, socket.error) as e:
+            print(e)
+            sys.exit(1)
+        return
+
+    encoding = arguments['--encoding']
+    if encoding is None:
+        encoding = default_encoding
+
+    filenames = arguments['<filename>']
+    output_dir = arguments['--output-dir']
+
+    if arguments['--build-index'] is not None:
+        import varindex
+        try:
+            index, parsed = varindex.build(arguments['--build-index'],
+                                           filenames, encoding=encoding)
+        except (IOError, OSError) as e:
+            print('Could not write index. %s' % e)
+            sys.exit(1)
+        print('Indexed %d documents, parsed %d' % (len(index.entries),
+                                                    parsed))
+        return
+
+    jobs = arguments['--jobs']
+    if jobs is not None:
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            jobs = 0
+        if jobs < 1:
+            print('Invalid number of jobs: %s' % arguments['--jobs'])
+            sys.exit(1)
+    if stats is not None:
+        # Phases are recorded only in this process
+        jobs = 1
+
+    cache_dir = arguments['--cache']
+
+    if arguments['--watch']:
+        if not filenames or (output_dir is None and
+                             arguments['--output'] is None):
+            print('Watch mode needs input files and --output or '
+                  '--output-dir.')
+            sys.exit(1)
+        try:
+            watch(filenames, output_dir=output_dir,
+                  output=arguments['--output'], encoding=encoding, jobs=jobs,
+                  cache=_render_cache(cache_dir), options=options)
+        except RenderError as e:
+            print(e)
+            sys.exit(1)
+        return
+
+    if arguments['--manifest'] is not None:
+        import manifest
+        try:
+            files, manifest_encoding = manifest.load(arguments['--manifest'])
+        except RenderError as e:
+            print(e)
+            sys.exit(1)
+        if arguments['--encoding'] is None and manifest_encoding:
+            encoding = manifest_encoding
+        result = manifest.build(files, encoding=encoding, jobs=jobs,
+                                cache=_render_cache(cache_dir),
+                                options=options)
+        print('\n'.join(result.report()))
+        if result.errors:
+            sys.exit(1)
+        return
+
+    if output_dir is not None:
+        try:
+            files = batch_files(filenames, output_dir)
+        except RenderError as e:
+            print(e)
+            sys.exit(1)
+        errors = render_files(files, encoding=encoding, jobs=jobs,
+                              cache=_render_cache(cache_dir),
+                              options=options)
+        for filename, message in errors:
+            print('%s: %s' % (filename, message))
+        if errors:
+            sys.exit(1)
+        return
+
+    # Read drydoc in from whatever source
+
+    filename = filenames[0] if filenames else None
+    text = None
+    if filename is None:
+        # This makes it possible to use via pipe e.g. x | python drydoc.py
+        text = sys.stdin.read()
+
+    # Render with server if there is one, it reads the file itself
+
+    chunks = None
+    address = arguments['--socket'] or os.environ.get('DRYDOC_SOCKET')
+    if address and stats is None:
+        import server
+        try:
+            rendered_text = server.render_remote(
+                address, filename, text, encoding=encoding, cache=cache_dir,
+                options=options)
+        except RenderError as e:
+            print(e)
+            sys.exit(1)
+        if rendered_text is not None:
+            chunks = [rendered_text]
+
+    # Otherwise parse and render the drydoc here. Without cache and stats,
+    # the document is rendered while it's written, so the whole output is
+    # never held in memory.
+
+    if chunks is None:
+        if text is None:
+            try:
+                if is_plain_file(filename, encoding=encoding):
+                    # Not a DRY document, output it without decoding
+                    copy_file(filename, arguments['--output'])
+                    return
+                text = read_document(filename, encoding=encoding)
+            except IOError as e:
+                print('Could not open file. %s' % e)
+                sys.exit(1)
+            except OutputError as e:
+                print(e)
+                sys.exit(1)
+
+        cache = _render_cache(cache_dir)
+        if cache is None and stats is None:
+            chunks = render_text_iter(text, filename, encoding=encoding,
+                                      options=options)
+        else:
+            try:
+                chunks = [render_text(text, filename, encoding=encoding,
+                                      cache=cache, options=options)]
+            except RenderError as e:
+                print(e)
+                sys.exit(1)
+
+    # Output the rendered text to where ever
+
+    # Errors of rendering chunks are raised as is, OutputError is raised
+    # when the output file can't be written. Output file is replaced only
+    # after the whole document is rendered.
+    output = arguments['--output']
+    try:
+        if output is not None:
+            write_chunks(chunks, output, encoding=encoding)
         else:
-            sys.stdout.write(rendered_text.encode(encoding, errors='replace'))
+            for chunk in chunks:
+                if not _PY3:
+                    chunk = chunk.encode(encoding, errors='replace')
+                sys.stdout.write(chunk)
+    except RenderError as e:
+        print(e)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
+    # Template functions import drydoc. Make them use this module instead of
+    # loading the script again as another module.
+    sys.modules.setdefault('drydoc', sys.modules[__name__])
     try:
         main()
     except KeyboardInterrupt:
@@ -0,0 +1,322 @@
+"""
+Builds a tree of DRY documents listed in a manifest file.
+Manifest is a JSON file, or YAML file if its extension is .yml or .yaml,
+which maps input files to output files. Paths are relative to the
+manifest's directory:
+
+    {"documents": {"index.txt": "site/index.html",
+                   "menu.txt": "site/menu.html"},
+     "encoding": "utf-8"}
+
+Documents can include() or filevars() outputs of other documents. Those
+documents are rendered first, and documents which don't depend on each
+other are rendered in parallel. Dependencies are found from include() and
+filevars() calls with constant paths, also in the documents they include.
+"""
+
+import collections
+import json
+import os
+import time
+
+import drydoc
+
+
+class BuildResult(object):
+    """Result of build. errors is list of (inputfile, error message) tuples,
+    durations is dict of inputfile: seconds it took to render and
+    dependencies is dict of inputfile: set of inputfiles whose outputs it
+    reads. warnings lists documents which read outputs of others in ways
+    which were not found before rendering.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.durations = collections.OrderedDict()
+        self.dependencies = {}
+        self.elapsed = 0.0
+
+    def critical_path(self):
+        """Returns the chain of rendered documents which took longest in
+        total, as list of (inputfile, seconds) tuples. Build can't be faster
+        than the sum of its durations, regardless of number of jobs.
+        """
+        finish = {}
+        previous = {}
+        # Durations are recorded in the order documents finished, so
+        # dependencies of each document are always handled before it
+        for filename in self.durations:
+            before = [d for d in self.dependencies.get(filename, ())
+                      if d in finish]
+            start = 0.0
+            if before:
+                previous[filename] = max(before, key=finish.get)
+                start = finish[previous[filename]]
+            finish[filename] = start + self.durations[filename]
+
+        if not finish:
+            return []
+        path = [max(finish, key=finish.get)]
+        while path[-1] in previous:
+            path.append(previous[path[-1]])
+        return [(f, self.durations[f]) for f in reversed(path)]
+
+    def report(self):
+        """Returns lines describing the build."""
+        lines = []
+        for filename, message in self.errors:
+            lines.append('%s: %s' % (filename, message))
+        for message in self.warnings:
+            lines.append('Warning: %s' % message)
+
+        path = self.critical_path()
+        if path:
+            lines.append('Rendered %d documents in %.0f ms' %
+                         (len(self.durations), self.elapsed * 1000))
+            lines.append('Critical path %.0f ms: %s' % (
+                sum(seconds for f, seconds in path) * 1000,
+                ' -> '.join('%s (%.0f ms)' % (f, seconds * 1000)
+                            for f, seconds in path)))
+        return lines
+
+
+def load(path):
+    """Returns (list of (inputfile, outputfile) tuples, encoding) of
+    manifest in path. encoding is None if manifest doesn't set it.
+    Raises drydoc.RenderError if manifest can't be read.
+    """
+    try:
+        data = drydoc.read_file(path)
+    except IOError as e:
+        raise drydoc.RenderError('Could not open manifest. %s' % e)
+
+    try:
+        if os.path.splitext(path)[1].lower() in ('.yml', '.yaml'):
+            import yaml
+            manifest = yaml.safe_load(data)
+        else:
+            manifest = json.loads(data)
+    except ImportError:
+        raise drydoc.RenderError('PyYAML is needed for YAML manifests')
+    except Exception as e:
+        raise drydoc.RenderError('Invalid manifest: %s' % e)
+
+    documents = manifest.get('documents') if isinstance(manifest, dict) \
+        else None
+    if not isinstance(documents, dict):
+        raise drydoc.RenderError('Manifest must map "documents" to a '
+                                 'dictionary of input: output files')
+
+    base = os.path.dirname(path)
+    files = [(os.path.join(base, inputfile), os.path.join(base, outputfile))
+             for inputfile, outputfile in sorted(documents.items())]
+    return files, manifest.get('encoding')
+
+
+def find_dependencies(filepath, outputs, encoding=drydoc.default_encoding):
+    """Returns set of paths in outputs which document in filepath reads with
+    include() or filevars(), directly or through documents it includes.
+    Only calls with constant paths are found.
+    """
+    if drydoc.default_engine != 'yj':
+        return set()
+    import yjengine
+
+    found = set()
+    seen = set([os.path.abspath(filepath)])
+    stack = [os.path.abspath(filepath)]
+    while stack:
+        path = stack.pop()
+        try:
+            text = drydoc.read_file(path, encoding=encoding)
+        except (IOError, ValueError):
+            # Rendering reports unreadable files
+            continue
+        template = drydoc.Sections(text).template
+        if template is None:
+            continue
+
+        docdir = os.path.dirname(path)
+        for name, ref, render in yjengine.find_file_calls(template):
+            target = os.path.abspath(os.path.join(docdir, ref))
+            if target in outputs:
+                found.add(target)
+            elif name == 'include' and render and target not in seen:
+                seen.add(target)
+                stack.append(target)
+    return found
+
+
+def strongly_connected(nodes, graph):
+    """Returns strongly connected components of graph, which is dict of
+    node: list of nodes it points to, as lists of nodes. Nodes in a
+    component can all reach each other. Components and nodes in them are
+    in the order of nodes. Uses Tarjan's algorithm without recursion.
+    """
+    order = dict((node, n) for n, node in enumerate(nodes))
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    for root in nodes:
+        if root in index:
+            continue
+        # Each entry is a node and iterator over the nodes it points to
+        work = [(root, iter(graph.get(root, ())))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, targets = work[-1]
+            for target in targets:
+                if target not in index:
+                    index[target] = lowlink[target] = len(index)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(graph.get(target, ()))))
+                    break
+                if target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component, key=order.get))
+
+    components.sort(key=lambda c: order[c[0]])
+    return components
+
+
+def _reachable(node, graph):
+    """Returns set of nodes reachable from node in graph."""
+    found = set()
+    stack = [node]
+    while stack:
+        for target in graph.get(stack.pop(), ()):
+            if target not in found:
+                found.add(target)
+                stack.append(target)
+    return found
+
+
+def _build_job(job):
+    """Renders one document and returns (error message, dependencies,
+    seconds) tuple.
+    """
+    start = time.time()
+    error, dependencies = drydoc._render_job(job)
+    return error, dependencies, time.time() - start
+
+
+def build(files, encoding=drydoc.default_encoding, jobs=None, cache=None,
+          options=None):
+    """Renders list of (inputfile, outputfile) tuples in dependency order,
+    in a pool of jobs worker processes. Documents are rendered as soon as
+    all documents whose output they read have been rendered. If jobs is
+    None, number of CPUs is used. With one job, documents are rendered in
+    this process. See drydoc.render_text for cache and options.
+    Returns BuildResult.
+    """
+    result = BuildResult()
+    start = time.time()
+
+    input_of = dict((os.path.abspath(o), i) for i, o in files)
+    output_of = dict(files)
+    dependants = dict((i, set()) for i, o in files)
+    for inputfile, outputfile in files:
+        deps = set(input_of[path] for path in
+                   find_dependencies(inputfile, input_of, encoding))
+        deps.discard(inputfile)
+        result.dependencies[inputfile] = deps
+        for dep in deps:
+            dependants[dep].add(inputfile)
+
+    waiting = dict((i, len(result.dependencies[i])) for i, o in files)
+    ready = [i for i, o in files if waiting[i] == 0]
+    failed = {}
+
+    def finish(inputfile, error, deps, seconds):
+        if error is None:
+            result.durations[inputfile] = seconds
+            for path in deps:
+                dep = input_of.get(path)
+                if dep is not None and dep != inputfile and \
+                   dep not in result.dependencies[inputfile]:
+                    result.warnings.append(
+                        '%s reads output of %s, which was not found before '
+                        'rendering, they may be rendered in wrong order' %
+                        (inputfile, dep))
+        else:
+            result.errors.append((inputfile, error))
+
+        for dependant in sorted(dependants[inputfile]):
+            if error is not None:
+                failed.setdefault(dependant, inputfile)
+            waiting[dependant] -= 1
+            if waiting[dependant] == 0:
+                if dependant in failed:
+                    finish(dependant, 'Not rendered, because %s failed' %
+                           failed[dependant], (), 0.0)
+                else:
+                    ready.append(dependant)
+
+    def job(inputfile):
+        return (inputfile, output_of[inputfile], encoding, cache, options)
+
+    if jobs == 1 or len(files) < 2:
+        while ready:
+            inputfile = ready.pop(0)
+            finish(inputfile, *_build_job(job(inputfile)))
+    else:
+        import multiprocessing
+        from concurrent import futures
+        workers = jobs or multiprocessing.cpu_count()
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            while ready or pending:
+                while ready:
+                    inputfile = ready.pop(0)
+                    future = executor.submit(_build_job, job(inputfile))
+                    pending[future] = inputfile
+                done, not_done = futures.wait(
+                    pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(pending.pop(future), *future.result())
+
+    # Documents which are still waiting are in a cycle of documents which
+    # read each other's output, or read output of documents in one
+    stuck = [i for i, o in files if waiting[i] > 0]
+    graph = dict((i, [d for d in stuck if d in result.dependencies[i]])
+                 for i in stuck)
+    cycle_of = {}
+    for component in strongly_connected(stuck, graph):
+        if len(component) > 1:
+            for inputfile in component:
+                cycle_of[inputfile] = component
+
+    for inputfile in stuck:
+        cycle = cycle_of.get(inputfile)
+        if cycle is not None:
+            message = 'Not rendered, documents read each other\'s ' \
+                'output: %s' % ', '.join(cycle)
+        else:
+            reachable = _reachable(inputfile, graph)
+            cycle = [d for d in stuck if d in reachable and d in cycle_of]
+            message = 'Not rendered, because it reads output of documents ' \
+                'in a cycle: %s' % ', '.join(cycle)
+        result.errors.append((inputfile, message))
+
+    result.elapsed = time.time() - start
+    return result
@@ -3,6 +3,13 @@ Example parsers for DRY document.
 They are very very simple for demonstration purposes.
 """
 
+import re
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
 
 example_doc = """
 a = testing..
@@ -13,21 +20,61 @@ Variable b is {{ b }}.
 """
 
 
+def _iter_lines(text):
+    """Returns iterable over lines of text. text can also be an iterable of
+    lines, such as a file object, so big headers don't have to be read to
+    memory at once. Strings are split in one pass, which is faster than
+    reading them line by line.
+    """
+    if isinstance(text, _string_types):
+        return text.split('\n')
+    return text
+
+
 def parse_variables(text):
+    """Parses lines of key = value pairs to dictionary. Value is everything
+    after the first '='. Empty lines are skipped.
+    """
     d = {}
-    for line in text.strip().split('\n'):
-        key, value = line.split('=')
+    for number, line in enumerate(_iter_lines(text), 1):
+        key, sep, value = line.partition('=')
+        if not sep:
+            if not key.strip():
+                continue
+            raise ValueError('Line %d is not a key = value pair: %s' %
+                             (number, line.strip()))
         d[key.strip()] = value.strip()
     return d
 
 
+# Placeholder is a variable name between '{{ ' and ' }}'. Name can't contain
+# '{{ ', so the closest opening braces are used.
+_placeholder = re.compile(r'\{\{ ((?:(?!\{\{ ).)*?) \}\}')
+
+
 class Template(object):
+    """Template which replaces {{ name }} placeholders with values of
+    variables. Variable names are lowercased in placeholders. Placeholders
+    of missing variables are left as they are.
+    Text is split to literal text and placeholders once, rendering only
+    joins the parts.
+    """
+
     def __init__(self, text):
         self.text = text
+        # Literal text and names alternate, names are at odd indexes
+        self._parts = _placeholder.split(text)
 
     def render(self, **kwargs):
-        rendered_text = self.text
+        values = {}
         for key, value in kwargs.items():
-            key = u'{{ %s }}' % key.lower()
-            rendered_text = rendered_text.replace(key, value)
-        return rendered_text
+            values.setdefault(key.lower(), value)
+
+        parts = list(self._parts)
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            if name in values:
+                parts[i] = values[name]
+            else:
+                parts[i] = u'{{ %s }}' % name
+        return u''.join(parts)
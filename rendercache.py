@@ -0,0 +1,97 @@
+"""
+Persistent cache for rendered DRY documents.
+Rendered output is stored together with fingerprints of everything the
+render depended on: the document text, all files read with include() or
+filevars() and version of the engine. Cached output is used only when none
+of them have changed.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+
+def hash_file(filepath):
+    """Returns hex digest of file's contents, or None if file can't be
+    read.
+    """
+    digest = hashlib.sha1()
+    try:
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+class RenderCache(object):
+    """Cache of rendered documents in directory. Each document is stored in
+    its own JSON file, so worker processes can use the same cache.
+    version identifies the engine, cached renders of other versions are
+    ignored.
+    """
+
+    def __init__(self, directory, version):
+        self.directory = directory
+        self.version = version
+
+    def _entry_path(self, filepath, encoding):
+        key = u'%s\0%s' % (os.path.abspath(filepath), encoding)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.json')
+
+    def get(self, filepath, text_hash, encoding):
+        """Returns (rendered text, list of dependencies) tuple, or None if
+        document is not cached or anything it depends on has changed.
+        text_hash is hash of the document's current text.
+        """
+        try:
+            with open(self._entry_path(filepath, encoding), 'rb') as f:
+                entry = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('version') != self.version or \
+           entry.get('text') != text_hash:
+            return None
+
+        dependencies = entry.get('dependencies', {})
+        for path, file_hash in dependencies.items():
+            if hash_file(path) != file_hash:
+                return None
+
+        return entry['rendered'], list(dependencies)
+
+    def put(self, filepath, text_hash, encoding, rendered, dependencies):
+        """Stores rendered text of document. dependencies are the files
+        document depended on when it was rendered. If dependencies has
+        hashes dict, like drydoc.Dependencies, hashes recorded when the
+        files were read are stored, others are hashed now.
+        """
+        hashes = getattr(dependencies, 'hashes', None) or {}
+        entry = {
+            'version': self.version,
+            'text': text_hash,
+            'dependencies': dict((path, hashes[path] if path in hashes
+                                  else hash_file(path))
+                                 for path in dependencies),
+            'rendered': rendered
+        }
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+        # Write to temporary file first, so readers never see partial entry
+        fd, tmppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(json.dumps(entry).encode('utf-8'))
+        entry_path = self._entry_path(filepath, encoding)
+        if os.name == 'nt' and os.path.exists(entry_path):
+            os.remove(entry_path)
+        os.rename(tmppath, entry_path)
@@ -0,0 +1,98 @@
+"""
+Timing of rendering phases.
+When drydoc.stats is set to a Stats object, reading files, parsing
+variables, compiling and rendering templates and template functions record
+the time they take to a tree of phases. Phases with the same name and
+detail under the same parent are combined, and their calls are counted.
+Phases are tracked per thread, so renders of asyncrender, which interleave
+in one thread, are not timed correctly.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+# Timer with the best resolution available
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class Phase(object):
+    """Node of the timing tree. elapsed is total time of all calls in
+    seconds, including the time spent in children.
+    """
+    __slots__ = ('name', 'detail', 'calls', 'elapsed', 'children')
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.calls = 0
+        self.elapsed = 0.0
+        self.children = collections.OrderedDict()
+
+    @property
+    def self_time(self):
+        """Time spent in this phase, but not in its children."""
+        return self.elapsed - sum(c.elapsed for c in self.children.values())
+
+
+class Stats(object):
+    """Records timing tree of phases. Each thread records its phases from
+    the root of the tree, so documents included in worker threads appear
+    at the top level.
+    """
+
+    def __init__(self):
+        self.root = Phase('total')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = [self.root]
+        return stack
+
+    @contextlib.contextmanager
+    def phase(self, name, detail=None):
+        """Context manager which records time spent in it as phase name.
+        detail tells e.g. which file was read.
+        """
+        stack = self._stack()
+        parent = stack[-1]
+        key = (name, detail)
+        with self._lock:
+            node = parent.children.get(key)
+            if node is None:
+                node = parent.children[key] = Phase(name, detail)
+
+        stack.append(node)
+        start = timer()
+        try:
+            yield node
+        finally:
+            elapsed = timer() - start
+            stack.pop()
+            with self._lock:
+                node.calls += 1
+                node.elapsed += elapsed
+
+    def format(self):
+        """Returns timing tree as list of lines."""
+        lines = ['%10s %10s %7s  %s' % ('ms', 'self ms', 'calls', 'phase')]
+
+        def add(node, depth):
+            label = node.name
+            if node.detail is not None:
+                label += ' ' + node.detail
+            lines.append('%10.2f %10.2f %7d  %s%s' % (
+                node.elapsed * 1000, node.self_time * 1000, node.calls,
+                '  ' * depth, label))
+            for child in node.children.values():
+                add(child, depth + 1)
+
+        for child in self.root.children.values():
+            add(child, 0)
+        total = sum(c.elapsed for c in self.root.children.values())
+        lines.append('%10.2f %10s %7s  total' % (total * 1000, '', ''))
+        return lines
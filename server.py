@@ -0,0 +1,375 @@
+"""
+Render server for DRY documents.
+Server keeps engines, compiled templates and parsed variables in memory
+between renders, and answers render requests over a Unix socket or a
+localhost TCP port. Address is a path of Unix socket, or host:port.
+Templates can execute commands with system(), so the server refuses to
+listen on other than loopback addresses. Any local program, e.g. a web
+browser, can connect to a TCP port, so TCP requests must also contain a
+token, which the server writes to a file only the user can read. The file
+is $DRYDOC_TOKEN_FILE, or .drydoc-<port>.token in home directory.
+
+Client sends one JSON object per line, and server answers each of them
+with one JSON object per line. Server closes the connection after the
+first line which is not a valid request:
+
+    {"path": "/abs/doc.txt", "text": "...", "cwd": "/abs/dir",
+     "encoding": "utf-8", "env": {"variable": "value"}, "options": {},
+     "cache": "/abs/cache/dir", "token": "..."}
+
+    {"ok": true, "output": "..."}
+    {"ok": false, "error": "..."}
+
+Only path or text is required. If text is given, path is used to resolve
+relative paths in template functions. Without path, they are resolved from
+cwd. env contains variables which override the ones in the document.
+options can contain the options listed in client_options.
+"""
+
+import binascii
+import errno
+import hmac
+import json
+import os
+import re
+import socket
+import stat
+import sys
+import tempfile
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import drydoc
+
+# Environment variable which contains the default server address
+address_env = 'DRYDOC_SOCKET'
+# Environment variable which overrides the path of TCP server's token file
+token_file_env = 'DRYDOC_TOKEN_FILE'
+# Seconds to wait for server to answer, before rendering in process
+client_timeout = 60
+# Render options clients can set, with their types
+client_options = {'max_include_depth': int, 'parallel_includes': bool,
+                  'variable_index': type(u'')}
+
+
+def default_address(serving=False):
+    """Returns server address from environment. If it's not set, returns
+    None, or path of socket in temp directory when serving is True.
+    """
+    address = os.environ.get(address_env) or None
+    if address is None and serving:
+        address = os.path.join(tempfile.gettempdir(), 'drydoc.sock')
+    return address
+
+
+def parse_address(address):
+    """Returns (host, port) tuple for TCP address host:port, or the address
+    itself for Unix socket path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in host:
+        return (host or 'localhost', int(port))
+    return address
+
+
+def token_path(port):
+    """Returns path of the token file of TCP server listening in port."""
+    path = os.environ.get(token_file_env)
+    if path:
+        return path
+    return os.path.join(os.path.expanduser('~'), '.drydoc-%d.token' % port)
+
+
+def write_token(path):
+    """Writes new random token to file in path, which only the user can
+    read, and returns the token.
+    """
+    token = binascii.hexlify(os.urandom(32)).decode('ascii')
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+def read_token(path):
+    """Returns token in file in path, or None if it can't be read."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def is_loopback(host):
+    """Returns True if all addresses of host are loopback addresses."""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.error:
+        return False
+
+    for info in infos:
+        ip = info[4][0].split('%')[0]
+        try:
+            import ipaddress
+            loopback = ipaddress.ip_address(u'%s' % ip).is_loopback
+        except ImportError:
+            loopback = ip.startswith('127.') or ip == '::1'
+        if not loopback:
+            return False
+    return bool(infos)
+
+
+def connect(address, timeout=None):
+    """Returns socket connected to server in address. Raises socket.error
+    if server is not running.
+    """
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        return socket.create_connection(address, timeout)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+
+def request(address, payload, timeout=client_timeout):
+    """Sends render request payload to server and returns its response.
+    Raises socket.error if server can't be reached.
+    """
+    parsed = parse_address(address)
+    if isinstance(parsed, tuple):
+        payload = dict(payload, token=read_token(token_path(parsed[1])))
+
+    sock = connect(address, timeout)
+    try:
+        f = sock.makefile('rwb')
+        f.write(json.dumps(payload).encode('utf-8') + b'\n')
+        f.flush()
+        line = f.readline()
+        f.close()
+    finally:
+        sock.close()
+
+    if not line:
+        raise socket.error('Server closed connection')
+    return json.loads(line.decode('utf-8'))
+
+
+def render_remote(address, filename=None, text=None,
+                  encoding=drydoc.default_encoding, cache=None, options=None):
+    """Renders document with server in address and returns rendered text.
+    Document is read from filename by server if text is not given. cache is
+    directory of render cache. Returns None if server can't be reached, so
+    caller can render the document itself. Raises drydoc.RenderError if
+    rendering fails.
+    """
+    payload = {'encoding': encoding, 'cwd': os.getcwd(),
+               'options': options or {}}
+    if filename is not None:
+        payload['path'] = os.path.abspath(filename)
+    if text is not None:
+        payload['text'] = text
+    if cache is not None:
+        payload['cache'] = os.path.abspath(cache)
+
+    try:
+        response = request(address, payload)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not response.get('ok'):
+        raise drydoc.RenderError(response.get('error', 'Unknown error.'))
+    return response['output']
+
+
+def check_options(options):
+    """Returns error message if options contains options which clients
+    can't set or values of wrong type, otherwise None.
+    """
+    if not isinstance(options, dict):
+        return 'Options must be an object.'
+
+    for name, value in sorted(options.items()):
+        expected = client_options.get(name)
+        if expected is None:
+            return 'Unknown option: %s' % name
+        # JSON has no separate booleans for int options
+        if not isinstance(value, expected) or \
+           (expected is int and isinstance(value, bool)):
+            return 'Invalid value for option %s: %r' % (name, value)
+        if name == 'max_include_depth' and value < 1:
+            return 'Invalid value for option %s: %r' % (name, value)
+    return None
+
+
+def render(payload, variable_cache=None):
+    """Renders document described by request payload and returns response
+    dictionary.
+    """
+    encoding = payload.get('encoding') or drydoc.default_encoding
+    path = payload.get('path')
+    text = payload.get('text')
+    options = payload.get('options') or {}
+    error = check_options(options)
+    if error is not None:
+        return {'ok': False, 'error': error}
+
+    options = dict(options)
+    if path is None and payload.get('cwd'):
+        options['docdir'] = payload['cwd']
+
+    try:
+        if text is None:
+            if path is None:
+                return {'ok': False, 'error': 'Request has no path or text.'}
+            try:
+                text = drydoc.read_document(path, encoding=encoding)
+            except IOError as e:
+                return {'ok': False, 'error': 'Could not open file. %s' % e}
+
+        cache = None
+        if payload.get('cache'):
+            import rendercache
+            cache = rendercache.RenderCache(payload['cache'],
+                                            drydoc.engine_version())
+
+        output = drydoc.render_text(text, path, encoding=encoding,
+                                    variable_cache=variable_cache,
+                                    cache=cache, env=payload.get('env'),
+                                    options=options)
+    except drydoc.RenderError as e:
+        return {'ok': False, 'error': str(e)}
+    except Exception as e:
+        return {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+
+    return {'ok': True, 'output': output}
+
+
+# Request line of HTTP request, e.g. POST / HTTP/1.1
+_http_request = re.compile(br'^[A-Z]+ \S+ HTTP/')
+
+
+def parse_request(line, token=None):
+    """Returns payload of request line. Raises ValueError if line is not a
+    JSON object, looks like an HTTP request or hasn't got token.
+    """
+    if _http_request.match(line):
+        raise ValueError('HTTP requests are not accepted')
+    payload = json.loads(line.decode('utf-8'))
+    if not isinstance(payload, dict):
+        raise ValueError('request must be an object')
+
+    if token is not None:
+        sent = payload.get('token')
+        if not isinstance(sent, type(u'')) or \
+           not hmac.compare_digest(sent.encode('utf-8'),
+                                   token.encode('utf-8')):
+            raise ValueError('invalid token')
+    return payload
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, b''):
+            try:
+                payload = parse_request(line, self.server.token)
+            except ValueError as e:
+                # Stop reading, so that lines of e.g. an HTTP request can't
+                # smuggle a render request
+                self.respond({'ok': False, 'error': 'Invalid request: %s' % e})
+                return
+            self.respond(render(payload, self.server.variable_cache))
+
+    def respond(self, response):
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def create_server(address):
+    """Returns server listening in address. Stale Unix socket file, which no
+    server is listening, is removed. Raises socket.error if the path is
+    some other file, and ValueError if address is a TCP address of other
+    than loopback interface. TCP server writes its token to token file,
+    whose path is in server's token_path.
+    """
+    parsed = parse_address(address)
+    token = None
+    path = None
+    if isinstance(parsed, tuple):
+        if not is_loopback(parsed[0]):
+            raise ValueError('Server can only listen on localhost, not %s' %
+                             parsed[0])
+        server = _TCPServer(parsed, _RequestHandler)
+        try:
+            # Port may have been picked by the system
+            path = token_path(server.server_address[1])
+            token = write_token(path)
+        except (IOError, OSError):
+            server.server_close()
+            raise
+    else:
+        if os.path.exists(parsed):
+            if not stat.S_ISSOCK(os.stat(parsed).st_mode):
+                raise socket.error(errno.EADDRINUSE,
+                                   '%s exists and is not a socket' % parsed)
+            try:
+                connect(parsed, timeout=1).close()
+            except socket.error:
+                os.remove(parsed)
+            else:
+                raise socket.error('Server is already running in %s' %
+                                   parsed)
+        server = _UnixServer(parsed, _RequestHandler)
+
+    # Parsed variables are shared by all requests, they are validated with
+    # file modification times
+    server.variable_cache = {}
+    server.token = token
+    server.token_path = path
+    return server
+
+
+def serve(address):
+    """Serves render requests in address until interrupted."""
+    # Load engine and build template functions before the first request
+    drydoc.engines[drydoc.default_engine]
+    if drydoc.default_engine == 'yj':
+        import templatefunctions
+        templatefunctions.get_funcs({})
+
+    server = create_server(address)
+    print('Serving in %s' % address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        parsed = parse_address(address)
+        if server.token_path is not None:
+            os.remove(server.token_path)
+        elif os.path.exists(parsed):
+            os.remove(parsed)
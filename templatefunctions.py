@@ -10,54 +10,291 @@ functions. Funtions are callable from templates without the prefix.
 # modified roughly.
 
 # Warning: All imported modules will be accessible from templates!
+import copy
 import os
 import sys
-import subprocess
+import threading
+import time
 import drydoc
 
 
 func_prefix = 'template_'
+# Maximum number of commands started by prefetch() running at once
+prefetch_workers = 8
+# Maximum number of included documents rendered at once, when
+# info['parallel_includes'] is set
+include_workers = 8
 
+_executors = {}
+_executor_lock = threading.Lock()
+_base_funcs_cache = None
 
-def assign_kwargs(func, **new_kwargs):
-    """Create wrapper funcion for func, which modifies kwargs to be passed
-    to func based on what new_kwargs contains.
+
+class Context(object):
+    """Holds info of the document which is being rendered.
+    Template functions of one render share a context and pass its info to
+    the functions, so they know e.g. the directory of the current document.
+    include() switches the context to the included document while it's
+    rendered.
+    """
+    __slots__ = ('info',)
+
+    def __init__(self, info):
+        self.info = info
+
+
+def bind(func, context):
+    """Create wrapper function for func, which passes info of the current
+    document in context to func.
     """
     def new_func(*args, **kwargs):
-        for key, value in new_kwargs.items():
-            if key not in kwargs:
-                kwargs[key] = value
+        if 'info' not in kwargs:
+            kwargs['info'] = context.info
         return func(*args, **kwargs)
     new_func.__name__ = func.__name__
     return new_func
 
 
-def template_system(cmd, info=None):
+def add_dependency(filepath, info):
+    """Records that the document being rendered depends on filepath."""
+    dependencies = info.get('dependencies')
+    if dependencies is not None:
+        dependencies.add(filepath)
+
+
+def run_command(cmd, docdir):
+    """Executes cmd in shell in docdir and returns its output."""
+    import subprocess
+    # Set working directory where the document is located
     PIPE = subprocess.PIPE
     STDOUT = subprocess.STDOUT
-    docdir = info['docdir']
-    # Set working directory where the document is located
     output = subprocess.Popen(cmd, stdout=PIPE, stderr=STDOUT, stdin=PIPE,
                               shell=True, cwd=docdir)
     return output.communicate()[0]
 
 
-def template_filevars(path, info=None):
+def _get_executor(name, workers):
+    """Returns thread pool by name, pool is created on first use. Separate
+    pools are used for tasks which wait for each other.
+    """
+    with _executor_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            from concurrent import futures
+            executor = futures.ThreadPoolExecutor(workers)
+            _executors[name] = executor
+    return executor
+
+
+class CommandCache(object):
+    """Cache of command outputs keyed by command and the directory where it
+    was executed. Outputs expire after ttl seconds, with ttl None they are
+    kept as long as the cache. Each render gets its own cache by default.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Returns future of cached command, or None if command is not
+        cached, its output has expired or it failed. Caller must hold the
+        lock.
+        """
+        entry = self._futures.get(key)
+        if entry is None:
+            return None
+
+        future, started = entry
+        if self.ttl is not None and time.time() - started > self.ttl:
+            del self._futures[key]
+            return None
+        if future.done() and future.exception() is not None:
+            # Failures may be temporary, the command is executed again
+            del self._futures[key]
+            return None
+        return future
+
+    def output(self, cmd, docdir):
+        """Returns output of cmd executed in docdir. Command is executed in
+        the calling thread, unless it's cached or already running.
+        """
+        from concurrent import futures
+
+        key = (cmd, docdir)
+        with self._lock:
+            future = self._lookup(key)
+            owner = future is None
+            if owner:
+                future = futures.Future()
+                self._futures[key] = (future, time.time())
+
+        if owner:
+            try:
+                future.set_result(run_command(cmd, docdir))
+            except Exception as e:
+                with self._lock:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+        return future.result()
+
+    def prefetch(self, cmds, docdir):
+        """Starts executing cmds in docdir in a thread pool. Commands which
+        are cached or already running are not started again.
+        """
+        for cmd in cmds:
+            key = (cmd, docdir)
+            with self._lock:
+                if self._lookup(key) is None:
+                    executor = _get_executor('prefetch', prefetch_workers)
+                    future = executor.submit(run_command, cmd, docdir)
+                    self._futures[key] = (future, time.time())
+
+
+def _mark_volatile(info):
+    """Records that the rendered document depends on something which can't
+    be tracked, so it can't be cached.
+    """
+    dependencies = info.get('dependencies')
+    if dependencies is not None:
+        dependencies.volatile = True
+
+
+def check_include(filepath, info):
+    """Checks that document in filepath can be included to the document
+    which is being rendered. Returns the include stack of the included
+    document. Raises drydoc.IncludeError if the document is already being
+    rendered, or includes would be nested deeper than
+    info['max_include_depth'].
+    """
+    include_stack = info.get('include_stack', ()) + (filepath,)
+    if filepath in include_stack[:-1]:
+        start = include_stack.index(filepath)
+        raise drydoc.IncludeError('Include cycle: %s' %
+                                  ' -> '.join(include_stack[start:]))
+
+    max_depth = info.get('max_include_depth')
+    if max_depth is not None and len(include_stack) - 1 > max_depth:
+        raise drydoc.IncludeError('Includes are nested deeper than %d: %s' %
+                                  (max_depth, ' -> '.join(include_stack)))
+    return include_stack
+
+
+def template_system(cmd, info=None):
     docdir = info['docdir']
-    filepath = os.path.abspath(os.path.join(docdir, path))
-    contents = drydoc.read_file(filepath, encoding=info['encoding'])
-    doc = drydoc.DryDoc(contents)
-    return doc.get_variables()
+    _mark_volatile(info)
+
+    with drydoc.phase('system', cmd):
+        cache = info.get('system_cache')
+        if cache is None:
+            return run_command(cmd, docdir)
+        return cache.output(cmd, docdir)
+
+
+def template_prefetch(*cmds, **kwargs):
+    """Starts executing cmds in parallel. system() calls of the same commands
+    return as soon as the command has finished. Returns empty string, so
+    it can be called in the template.
+    """
+    info = kwargs['info']
+    _mark_volatile(info)
+
+    cache = info.get('system_cache')
+    if cache is not None:
+        cache.prefetch(cmds, info['docdir'])
+    return ''
+
+
+def template_filevars(path, info=None):
+    filepath = os.path.abspath(os.path.join(info['docdir'], path))
+    with drydoc.phase('filevars', filepath):
+        return _filevars(filepath, info)
+
+
+def _variable_index(info):
+    """Returns VariableIndex given in variable_index option, or None."""
+    path = info.get('variable_index')
+    if not path:
+        return None
+    import varindex
+    return varindex.get_index(path)
+
+
+def _copy_variables(variables):
+    """Returns deep copy of variables. Cached variables are shared by
+    renders, so templates which modify them must get their own copy.
+    """
+    return drydoc.AttributeDict(copy.deepcopy(dict(variables)))
+
+
+def _filevars(filepath, info):
+    add_dependency(filepath, info)
+
+    # Each render copies variables of a file once, and later calls in the
+    # same render return the same copy
+    copies = info.get('render_variables')
+    if copies is not None:
+        variables = copies.get(filepath)
+        if variables is not None:
+            return variables
+
+    variables = _copy_variables(_read_filevars(filepath, info))
+    if copies is not None:
+        copies[filepath] = variables
+    return variables
+
+
+def _read_filevars(filepath, info):
+    """Returns variables of document in filepath, which may be shared with
+    other renders.
+    """
+    # Parsed variables are cached by path. Cached variables are used as long
+    # as the file's modification time and size stay the same.
+    cache = info.get('variable_cache')
+    index = _variable_index(info)
+    if cache is not None or index is not None:
+        fingerprint = drydoc.file_fingerprint(filepath)
+    if cache is not None:
+        cached = cache.get(filepath)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+    # Prebuilt index is used for documents which haven't changed since it
+    # was built
+    variables = None
+    if index is not None:
+        variables = index.get(filepath, fingerprint, info['encoding'])
+    if variables is None:
+        variables = drydoc.read_variables(filepath, encoding=info['encoding'])
+
+    if cache is not None:
+        cache[filepath] = (fingerprint, variables)
+    return variables
 
 
 def template_include(path, render=True, info=None):
     """Returns document in path. path is relative to the document where
     include is called. By default, document is rendered as DRY doc.
     """
-    docdir = info['docdir']
-    filepath = os.path.abspath(os.path.join(docdir, path))
+    filepath = os.path.abspath(os.path.join(info['docdir'], path))
+    with drydoc.phase('include', filepath):
+        return _include(filepath, render, info)
+
+
+def _include(filepath, render, info):
+    add_dependency(filepath, info)
+
+    if render:
+        include_stack = check_include(filepath, info)
+
+    prerendered = info.get('prerendered')
+    if prerendered:
+        future = prerendered.get((filepath, render))
+        if future is not None:
+            return future.result()
 
-    contents = drydoc.read_file(filepath)
+    contents = drydoc.file_cache.read(filepath)
     if not render:
         return contents
     doc = drydoc.DryDoc(contents)
@@ -69,48 +306,93 @@ def template_include(path, render=True, info=None):
     # Update document's location to next template
     newdir = os.path.split(filepath)[0]
     newinfo['docdir'] = newdir
+    newinfo['include_stack'] = include_stack
+
+    context = info.get('context')
+    if context is None:
+        # Called outside of a render, create functions for the document
+        env = dict(info.get('template_env', {}))
+        env.update(get_funcs(newinfo))
+        return doc.render(env=env)
+
+    # Template functions are shared with the including document, they
+    # consult the context while the included document is rendered
+    previous = context.info
+    context.info = newinfo
+    try:
+        return doc.render(env=info['template_env'])
+    finally:
+        context.info = previous
+
+
+def prerender_includes(doc, info):
+    """Starts rendering documents included by doc in a thread pool.
+    include() calls in doc return the results instead of rendering the
+    documents again, so the included documents are rendered in parallel,
+    while the results still appear in template order. Only include() calls
+    with constant arguments can be found before rendering.
+    """
+    import yjengine
 
-    # Create new template functions and pass newinfo which contains the
-    # new docdir to them
-    newfuncs = {}
-    for name, func in info['template_funcs'].items():
-        funcname = getattr(func, '__name__', None)
+    template = doc.sections.template
+    if template is None:
+        return
 
-        # Assign newinfo to all template functions
-        if funcname is not None and func.__name__.startswith(func_prefix):
-            newfunc = assign_kwargs(func, info=newinfo)
-            newfunc.__name__ = func.__name__
-            newname = func.__name__[len(func_prefix):]
-            newfuncs[newname] = newfunc
-        else:
-            newfuncs[name] = func
+    executor = _get_executor('include', include_workers)
+    prerendered = {}
+    for path, render in yjengine.find_includes(template):
+        filepath = os.path.abspath(os.path.join(info['docdir'], path))
+        key = (filepath, render)
+        if key not in prerendered:
+            prerendered[key] = executor.submit(_render_include, path, render,
+                                               info)
+    info['prerendered'] = prerendered
 
-    newinfo['template_funcs'] = newfuncs
-    env = newinfo['template_env']
-    env.update(newfuncs)
-    return doc.render(env=env)
+
+def _render_include(path, render, info):
+    """Renders included document in a worker thread. The document gets its
+    own template functions, because context of the including document is
+    used by the thread rendering it.
+    """
+    newinfo = info.copy()
+    # Documents rendered in workers include their documents sequentially,
+    # so workers never wait for each other
+    newinfo['prerendered'] = None
+    env = dict(info['template_env'])
+    newinfo['template_env'] = env
+    env.update(get_funcs(newinfo))
+    return template_include(path, render=render, info=newinfo)
+
+
+def _base_funcs():
+    """Returns module globals and builtins, which are accessible from
+    templates. Built once, since they don't depend on the document.
+    """
+    global _base_funcs_cache
+    if _base_funcs_cache is None:
+        d = {}
+        # Evilly add all global functions to be used in templates
+        d.update(globals())
+        d.update(globals()['__builtins__'])
+        _base_funcs_cache = d
+    return _base_funcs_cache
 
 
 def get_funcs(info):
     """Returns all functions that are callable from jinja templates in
     dict format. info is additional info to template functions provided from
-    main program.
+    main program. Template functions consult context, which is stored in
+    info['context'].
     """
-    d = {}
-    # Evilly add all global functions to be used in templates
-    d.update(globals())
-    d.update(globals()['__builtins__'])
+    d = dict(_base_funcs())
+
+    context = Context(info)
+    info['context'] = context
 
     # Add all functions from this module which start with func_prefix.
-    funcs = []
     for name in dir(sys.modules[__name__]):
         if name.startswith(func_prefix):
-            funcs.append(globals()[name])
-
-    for func in funcs:
-        newfunc = assign_kwargs(func, info=info)
-        newfunc.__name__ = func.__name__
-        newname = func.__name__[len(func_prefix):]
-        d[newname] = newfunc
+            func = globals()[name]
+            d[name[len(func_prefix):]] = bind(func, context)
 
     return d
@@ -8,8 +8,11 @@ Tests for DRY document rendering.
 
 import filecmp
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 import unittest
 
 _PY3 = sys.version_info >= (3, 0)
@@ -89,6 +92,37 @@ class TestDryTextRender(unittest.TestCase):
         self.assertEqual(_JINJA2 and _YAML, 'yj' in drydoc.engines,
                          'yj engine is missing')
 
+    def test_lazy_engines(self):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return drydoc.engines['example']
+
+        engines = drydoc.Engines()
+        engines.register('lazy', loader)
+        engines.register('missing', loader, requires=('no_such_module',))
+        self.assertEqual(loads, [], 'engine was loaded on register')
+        self.assertTrue('lazy' in engines)
+        self.assertFalse('missing' in engines)
+
+        self.assertEqual(engines.get('missing'), None)
+        self.assertEqual(list(engines.keys()), ['lazy'])
+        self.assertEqual(loads, [], 'engine was loaded when listed')
+
+        self.assertTrue(engines.get('lazy') is engines['lazy'])
+        self.assertEqual(loads, [1], 'engine was not loaded exactly once')
+        self.assertEqual(dict(engines.items()), {'lazy': engines['lazy']})
+
+    def test_diagnostics(self):
+        lines = drydoc.diagnostics()
+        self.assertEqual(lines[0], 'drydoc %s' % drydoc.__version__)
+        if _YAML and _JINJA2:
+            import yjengine
+            loader = 'YAML loader: %s' % yjengine.YamlLoader.__name__
+            self.assertTrue(any(l.startswith(loader) for l in lines),
+                            'yaml loader is not reported')
+
     def test_correct_example(self):
         rendered = example_render_func(correct_example)
         self.assertEqual(correct_rendered, rendered,
@@ -114,6 +148,82 @@ class TestDryTextRender(unittest.TestCase):
         err = 'dry doc with no section separator rendered incorrectly'
         self.assertEqual(rendered, no_section_separator, err)
 
+    def test_sections(self):
+        sections = drydoc.DryDoc(correct_example).sections
+        variables, template = correct_example.split('\n...\n')
+        self.assertEqual(sections.variables, variables)
+        self.assertEqual(sections.template, template)
+
+        sections = drydoc.DryDoc(empty_variable_definitions).sections
+        self.assertEqual(sections.variables, '')
+        self.assertEqual(sections.template, 'document template\n')
+
+        sections = drydoc.DryDoc(no_section_separator).sections
+        self.assertFalse(sections.is_dry)
+        self.assertEqual(sections.template, None)
+
+    def test_render_iter(self):
+        texts = [correct_example, empty_variable_definitions, empty_template,
+                 no_section_separator]
+        for text in texts:
+            doc = drydoc.DryDoc(text, engine=drydoc.engines['example'])
+            self.assertEqual(u''.join(doc.render_iter()), doc.render())
+
+        if _YAML and _JINJA2:
+            texts = [correct_yaml_jinja,
+                     u'...\n\n{% if 1 %}\n\n{% endif %}a\n',
+                     u'...\n{% for i in [1, 2] %}{{ i }}{% endfor %}\n']
+            for text in texts:
+                doc = drydoc.DryDoc(text, engine=drydoc.engines['yj'])
+                self.assertEqual(u''.join(doc.render_iter()), doc.render())
+
+    def test_bytecode_cache(self):
+        if not (_YAML and _JINJA2):
+            return
+        import yjengine
+        environment = yjengine._environment
+        old_dir = os.environ.get(yjengine.bytecode_cache_env)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.environ[yjengine.bytecode_cache_env] = tmpdir
+            yjengine._environment = None
+            t = yjengine.compile_template(u'a={{ a }}\n')
+            self.assertEqual(t.render(a=1), 'a=1\n')
+            self.assertEqual(len(os.listdir(tmpdir)), 1,
+                             'bytecode was not written to cache')
+        finally:
+            yjengine._environment = environment
+            if old_dir is None:
+                del os.environ[yjengine.bytecode_cache_env]
+            else:
+                os.environ[yjengine.bytecode_cache_env] = old_dir
+            shutil.rmtree(tmpdir)
+
+    def test_example_parsers(self):
+        import parsers
+        variables = parsers.parse_variables(u' a = b = c\n\nB=1\r')
+        self.assertEqual(variables, {'a': 'b = c', 'B': '1'})
+        self.assertEqual(parsers.parse_variables(iter([u'a=1\n', u'b=2\n'])),
+                         {'a': '1', 'b': '2'})
+        self.assertRaises(ValueError, parsers.parse_variables, u'a=1\nb\n')
+
+        t = parsers.Template(u'{{ a }}{{ b }} {{ {{ a }} {{ missing }}')
+        self.assertEqual(t.render(A=u'{{ b }}', b=u'2'),
+                         u'{{ b }}2 {{ {{ b }} {{ missing }}')
+
+    def test_template_cache(self):
+        cache = drydoc.TemplateCache(maxsize=2)
+        engine = drydoc.engines['example'][1][0]
+        first = cache.get(engine, u'a={{ a }}')
+        self.assertTrue(cache.get(engine, u'a={{ a }}') is first)
+        cache.get(engine, u'b={{ b }}')
+        cache.get(engine, u'c={{ c }}')
+
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(len(cache), 2, 'cache grew over maxsize')
+        self.assertFalse(cache.get(engine, u'a={{ a }}') is first,
+                         'least recently used template was not evicted')
+
 
 class TestDryFileRender(unittest.TestCase):
     """Test file reading and writing"""
@@ -136,6 +246,375 @@ class TestDryFileRender(unittest.TestCase):
 
         os.remove(filepath)
 
+    def test_read_document(self):
+        filepath = scriptdir + '/test_drydoc.txt'
+        contents = [b'', b'...\nT', b'\n...\nT', b'a...\n....\nT',
+                    b'a = 1\r\n...\r\n{{ a }}\r\n', b'a = \xc3\xa4\n...\n',
+                    correct_example.encode('utf-8')]
+        try:
+            for data in contents:
+                with open(filepath, 'wb') as f:
+                    f.write(data)
+                text = drydoc.read_file(filepath)
+                doc = drydoc.read_document(filepath,
+                                           engine=drydoc.engines['example'])
+                # Document doesn't depend on the file after reading
+                with open(filepath, 'wb'):
+                    pass
+                sections = drydoc.Sections(text)
+                self.assertEqual(doc.sections.variables, sections.variables)
+                self.assertEqual(doc.sections.template, sections.template)
+                self.assertEqual(doc.text, text)
+                self.assertEqual(doc.render(), example_render_func(text))
+        finally:
+            os.remove(filepath)
+
+    def test_read_variables(self):
+        filepath = scriptdir + '/test_drydoc.txt'
+        engine = drydoc.engines['example']
+        # Separator split between chunks, and a body which can't
+        # be decoded
+        contents = [b'', b'a = 1\n...', b'...\nT', b'a = 1\r\n...\r\nT',
+                    b'a = ' + b'x' * 8190 + b'\nb = 2\n...\nT',
+                    b'a = \xc3\xa4\n...\n' + b'\xff' * 10000,
+                    correct_example.encode('utf-8')]
+        try:
+            for data in contents:
+                with open(filepath, 'wb') as f:
+                    f.write(data)
+                text = data.replace(b'\xff', b'').decode('utf-8')
+                doc = drydoc.DryDoc(text.replace('\r\n', '\n'), engine=engine)
+                self.assertEqual(
+                    drydoc.read_variables(filepath, engine=engine),
+                    doc.get_variables())
+        finally:
+            os.remove(filepath)
+
+
+class TestBatchRender(unittest.TestCase):
+    """Test rendering many documents in one process"""
+
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def test_batch_files(self):
+        files = drydoc.batch_files([scriptdir + '/dirA',
+                                    scriptdir + '/filevar*.txt'],
+                                   self.outdir)
+        outputs = [os.path.relpath(o, self.outdir) for f, o in files]
+        self.assertEqual(outputs, ['a.txt', 'a1.txt', 'pwd.txt', 'pwd1.txt',
+                                   os.path.join('dirB', 'b.txt'),
+                                   'filevars.txt'])
+
+        # Same file twice is rendered once, different files with the same
+        # name can't be written to the same output
+        files = drydoc.batch_files([scriptdir + '/filevars.txt'] * 2,
+                                   self.outdir)
+        self.assertEqual(len(files), 1)
+        self.assertRaises(drydoc.RenderError, drydoc.batch_files,
+                          [scriptdir + '/dirA/a.txt', scriptdir + '/a.txt'],
+                          self.outdir)
+
+    def test_render_files(self):
+        if not (_YAML and _JINJA2):
+            return
+        files = [(scriptdir + '/include.txt', self.outdir + '/include.txt'),
+                 (scriptdir + '/missing.txt', self.outdir + '/missing.txt'),
+                 (scriptdir + '/filevars.txt', self.outdir + '/sub/f.txt')]
+        dependencies = {}
+        errors = drydoc.render_files(files, jobs=2, dependencies=dependencies)
+
+        self.assertEqual([f for f, e in errors], [scriptdir + '/missing.txt'])
+        dirA = os.path.join(scriptdir, 'dirA')
+        self.assertEqual(dependencies[scriptdir + '/include.txt'],
+                         set([os.path.join(dirA, 'a.txt'),
+                              os.path.join(dirA, 'a1.txt'),
+                              os.path.join(dirA, 'dirB', 'b.txt')]))
+        rendered = drydoc.read_file(self.outdir + '/include.txt')
+        self.assertEqual(rendered, 'CONTENTCONTENT')
+        rendered = drydoc.read_file(self.outdir + '/sub/f.txt')
+        self.assertEqual(rendered, '1VAR')
+
+    def test_render_cache(self):
+        if not (_YAML and _JINJA2):
+            return
+        import rendercache
+        cache = rendercache.RenderCache(self.outdir + '/cache',
+                                        drydoc.engine_version())
+        docpath = self.outdir + '/doc.txt'
+        snippet = self.outdir + '/snippet.txt'
+        text = u'...\n{{ include("snippet.txt") }}'
+        drydoc.write_file(text, docpath)
+        drydoc.write_file(u'one', snippet)
+        text_hash = drydoc.hash_text(text)
+
+        self.assertEqual(drydoc.render_text(text, docpath, cache=cache), 'one')
+        self.assertEqual(cache.get(docpath, text_hash, 'utf-8'),
+                         ('one', [snippet]))
+
+        drydoc.write_file(u'two', snippet)
+        self.assertEqual(cache.get(docpath, text_hash, 'utf-8'), None,
+                         'cache was used after dependency changed')
+        self.assertEqual(drydoc.render_text(text, docpath, cache=cache), 'two')
+
+        # Snippet changes after it was included, during the same render
+        def change():
+            drydoc.write_file(u'three', snippet)
+            return ''
+        text = u'...\n{{ include("snippet.txt") }}{{ change() }}'
+        drydoc.template_env['change'] = change
+        try:
+            self.assertEqual(drydoc.render_text(text, docpath, cache=cache),
+                             'two')
+        finally:
+            del drydoc.template_env['change']
+        self.assertEqual(cache.get(docpath, drydoc.hash_text(text), 'utf-8'),
+                         None, 'output of old snippet was cached for new one')
+
+    def test_manifest(self):
+        if not (_YAML and _JINJA2):
+            return
+        import manifest
+        docs = {'menu.txt': u'...\nmenu',
+                'index.txt': u'...\n[{{ include("site/menu.html") }}]',
+                'page.txt': u'...\n{{ include("part.txt") }}',
+                'part.txt': u'...\n<{{ include("site/index.html") }}>',
+                'a.txt': u'...\n{{ include("site/b.html") }}',
+                'b.txt': u'...\n{{ include("site/a.html") }}',
+                'c.txt': u'...\n{{ include("site/a.html") }}'}
+        for name, text in docs.items():
+            drydoc.write_file(text, os.path.join(self.outdir, name))
+        manifest_path = os.path.join(self.outdir, 'manifest.json')
+        drydoc.write_file(u'{"documents": {"menu.txt": "site/menu.html", '
+                          u'"index.txt": "site/index.html", '
+                          u'"page.txt": "site/page.html", '
+                          u'"a.txt": "site/a.html", '
+                          u'"b.txt": "site/b.html", '
+                          u'"c.txt": "site/c.html"}}', manifest_path)
+
+        files, encoding = manifest.load(manifest_path)
+        result = manifest.build(files, jobs=2)
+        page = os.path.join(self.outdir, 'page.txt')
+        self.assertEqual(result.dependencies[page],
+                         set([os.path.join(self.outdir, 'index.txt')]))
+        self.assertEqual(drydoc.read_file(self.outdir + '/site/page.html'),
+                         '<[menu]>')
+        errors = dict((os.path.basename(f), e) for f, e in result.errors)
+        self.assertEqual(sorted(errors), ['a.txt', 'b.txt', 'c.txt'])
+        cycle = '%s, %s' % (os.path.join(self.outdir, 'a.txt'),
+                            os.path.join(self.outdir, 'b.txt'))
+        self.assertEqual(errors['a.txt'], 'Not rendered, documents read '
+                         'each other\'s output: ' + cycle)
+        self.assertEqual(errors['c.txt'], 'Not rendered, because it reads '
+                         'output of documents in a cycle: ' + cycle)
+        self.assertEqual([os.path.basename(f)
+                          for f, s in result.critical_path()],
+                         ['menu.txt', 'index.txt', 'page.txt'])
+
+    def test_write_chunks(self):
+        output = os.path.join(self.outdir, 'out.txt')
+        drydoc.write_file(u'old', output)
+
+        def chunks():
+            yield u'partial'
+            raise IOError('render failed')
+        self.assertRaises(IOError, drydoc.write_chunks, chunks(), output)
+        self.assertEqual(drydoc.read_file(output), 'old',
+                         'output was changed by a failed render')
+        self.assertEqual(os.listdir(self.outdir), ['out.txt'],
+                         'temporary file was left behind')
+
+        drydoc.write_chunks([u'a', u'b'], output)
+        self.assertEqual(drydoc.read_file(output), 'ab')
+        self.assertRaises(drydoc.OutputError, drydoc.write_file, u'x',
+                          os.path.join(self.outdir, 'missing', 'out.txt'))
+
+    def test_plain_files(self):
+        if os.linesep != '\n':
+            return
+        contents = [b'\x89PNG\n\x00\xff\xfe', b'plain ... text\n',
+                    b'a = 1\r\nb\r\n']
+        inputfile = os.path.join(self.outdir, 'in.txt')
+        output = os.path.join(self.outdir, 'sub', 'out.txt')
+        for data in contents[:2]:
+            with open(inputfile, 'wb') as f:
+                f.write(data)
+            self.assertTrue(drydoc.is_plain_file(inputfile))
+            drydoc.render_file(inputfile, output)
+            with open(output, 'rb') as f:
+                self.assertEqual(f.read(), data, 'file was not copied as is')
+
+        # Documents and files whose line endings change are rendered
+        for data in [contents[2], b'a = 1\n...\nT']:
+            with open(inputfile, 'wb') as f:
+                f.write(data)
+            self.assertFalse(drydoc.is_plain_file(inputfile))
+
+    def test_file_cache(self):
+        cache = drydoc.FileCache(maxsize=10)
+        paths = [os.path.join(self.outdir, name) for name in 'abc']
+        for path in paths:
+            drydoc.write_file(u'12345', path)
+
+        self.assertEqual(cache.read(paths[0]), '12345')
+        self.assertEqual(cache.read(paths[0]), '12345')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.read(paths[1])
+        cache.read(paths[2])
+        self.assertEqual((len(cache), cache.size), (2, 10),
+                         'cache grew over maxsize')
+        cache.read(paths[0])
+        self.assertEqual(cache.misses, 4,
+                         'least recently used file was not evicted')
+
+        drydoc.write_file(u'123', paths[0])
+        self.assertEqual(cache.read(paths[0]), '123',
+                         'changed file was not read again')
+        self.assertEqual(cache.size, 8)
+
+    def test_server(self):
+        if not (_YAML and _JINJA2):
+            return
+        import socket
+        import threading
+        import server
+        address = self.outdir + '/drydoc.sock'
+        self.assertEqual(server.render_remote(address, text=u'...\nx'), None)
+        self.assertRaises(ValueError, server.create_server, '0.0.0.0:0')
+        drydoc.write_file(u'keep', address)
+        self.assertRaises(socket.error, server.create_server, address)
+        self.assertEqual(drydoc.read_file(address), 'keep')
+        os.remove(address)
+
+        s = server.create_server(address)
+        thread = threading.Thread(target=s.serve_forever)
+        thread.start()
+        try:
+            docpath = scriptdir + '/include.txt'
+            self.assertEqual(server.render_remote(address, docpath),
+                             'CONTENTCONTENT')
+            text = u'a: 1\n...\n{{ a }}{{ include("dirA/a.txt") }}'
+            self.assertEqual(server.render_remote(address, docpath, text),
+                             '1CONTENTCONTENT')
+            response = server.request(address, {'text': text,
+                                                 'cwd': scriptdir,
+                                                 'env': {'a': 2}})
+            self.assertEqual(response,
+                             {'ok': True, 'output': '2CONTENTCONTENT'})
+            self.assertRaises(drydoc.RenderError, server.render_remote,
+                              address, scriptdir + '/missing.txt')
+            for options in [{'docdir': self.outdir},
+                            {'dependencies': []},
+                            {'max_include_depth': True},
+                            {'max_include_depth': 0},
+                            {'parallel_includes': 1}]:
+                response = server.request(address, {'text': text,
+                                                     'cwd': scriptdir,
+                                                     'options': options})
+                self.assertEqual(response['ok'], False)
+            response = server.request(address, {
+                'text': text, 'cwd': scriptdir,
+                'options': {'max_include_depth': 2,
+                            'parallel_includes': True}})
+            self.assertEqual(response,
+                             {'ok': True, 'output': '1CONTENTCONTENT'})
+        finally:
+            s.shutdown()
+            s.server_close()
+            thread.join()
+
+    def test_server_tcp(self):
+        if not (_YAML and _JINJA2):
+            return
+        import socket
+        import threading
+        import server
+        os.environ[server.token_file_env] = self.outdir + '/token'
+        try:
+            s = server.create_server('localhost:0')
+        finally:
+            del os.environ[server.token_file_env]
+        thread = threading.Thread(target=s.serve_forever)
+        thread.start()
+        try:
+            address = 'localhost:%d' % s.server_address[1]
+            self.assertEqual(s.token_path, self.outdir + '/token')
+            self.assertEqual(os.stat(s.token_path).st_mode & 0o777, 0o600)
+            os.environ[server.token_file_env] = s.token_path
+            try:
+                self.assertEqual(server.render_remote(address, text=u'...\nx'),
+                                 'x')
+            finally:
+                del os.environ[server.token_file_env]
+
+            # Web pages can send requests like this to localhost
+            body = (u'{"text": "...\\n{{ system(\'echo PWNED\') }}", '
+                    u'"token": "%s"}\n' % s.token).encode('utf-8')
+            requests = [b'POST / HTTP/1.1\r\nHost: localhost\r\n'
+                        b'Content-Type: text/plain\r\n\r\n' + body,
+                        b'\n' + body,
+                        body.replace(s.token.encode('ascii'), b'x'),
+                        body.replace(b', "token"', b', "t"')]
+
+            def send(data):
+                sock = socket.create_connection(s.server_address)
+                try:
+                    sock.sendall(data)
+                    sock.shutdown(socket.SHUT_WR)
+                    received = b''
+                    for chunk in iter(lambda: sock.recv(4096), b''):
+                        received += chunk
+                finally:
+                    sock.close()
+                return received
+
+            self.assertTrue(b'PWNED' in send(body))
+            for data in requests:
+                received = send(data)
+                self.assertEqual(received.count(b'\n'), 1, received)
+                self.assertTrue(b'"ok": false' in received, received)
+                self.assertFalse(b'PWNED' in received, 'request was rendered')
+        finally:
+            s.shutdown()
+            s.server_close()
+            thread.join()
+
+    def test_variable_index(self):
+        if not (_YAML and _JINJA2):
+            return
+        import varindex
+        docdir = os.path.join(self.outdir, 'docs')
+        os.mkdir(docdir)
+        drydoc.write_file(u'name: a\n...\n', os.path.join(docdir, 'a.txt'))
+        drydoc.write_file(u'name: b\n...\n', os.path.join(docdir, 'b.txt'))
+        indexpath = os.path.join(self.outdir, 'index.pickle')
+
+        index, parsed = varindex.build(indexpath, [docdir])
+        self.assertEqual((len(index.entries), parsed), (2, 2))
+        index, parsed = varindex.build(indexpath)
+        self.assertEqual(parsed, 0, 'unchanged documents were parsed again')
+
+        # Variables come from the index while the document is unchanged
+        apath = os.path.abspath(os.path.join(docdir, 'a.txt'))
+        index.entries[apath] = (index.entries[apath][0], {'name': 'indexed'})
+        index.save(indexpath)
+        text = (u'...\n{{ filevars("a.txt").name }} '
+                u'{{ filevars("b.txt").name }}')
+        options = {'variable_index': indexpath}
+        self.assertEqual(drydoc.render_text(text, docdir + '/doc.txt',
+                                            options=options), 'indexed b')
+
+        drydoc.write_file(u'name: changed\n...\n', apath)
+        self.assertEqual(drydoc.render_text(text, docdir + '/doc.txt',
+                                            options=options), 'changed b')
+        os.remove(os.path.join(docdir, 'b.txt'))
+        index, parsed = varindex.build(indexpath)
+        self.assertEqual((len(index.entries), parsed), (1, 1))
+
 
 class TestFunctions(unittest.TestCase):
     """Test templatefunctions"""
@@ -172,6 +651,207 @@ class TestFunctions(unittest.TestCase):
         self.assertEqual(rendered, filedir + '\n',
                          'system function failed pwd test')
 
+    def test_filevars_cache(self):
+        if not (_YAML and _JINJA2):
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'vars.txt')
+            drydoc.write_file(u'a: 1\n...\n', filepath)
+            info = {'docdir': tmpdir, 'encoding': 'utf-8',
+                    'variable_cache': {}}
+            func = templatefunctions.template_filevars
+
+            cache = info['variable_cache']
+            variables = func('vars.txt', info)
+            cached = cache[os.path.abspath(filepath)]
+            variables.a = 2
+            self.assertEqual(func('vars.txt', info).a, 1,
+                             'template modified cached variables')
+            self.assertTrue(cache[os.path.abspath(filepath)] is cached,
+                            'filevars were parsed again')
+
+            drydoc.write_file(u'a: 10\n...\n', filepath)
+            self.assertEqual(func('vars.txt', info).a, 10,
+                             'filevars returned variables of old file')
+
+            # Variables are copied once per render
+            info['render_variables'] = {}
+            variables = func('vars.txt', info)
+            self.assertTrue(func('vars.txt', info) is variables,
+                            'variables were copied again in the same render')
+            self.assertFalse(cache[os.path.abspath(filepath)][1] is variables)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_system_cache(self):
+        info = {'docdir': scriptdir,
+                'system_cache': templatefunctions.CommandCache()}
+        func = templatefunctions.template_system
+        cmd = 'python -c "import time; print(time.time())"'
+        self.assertEqual(func(cmd, info), func(cmd, info),
+                         'command was executed again')
+
+        info['system_cache'] = templatefunctions.CommandCache(ttl=0)
+        first = func(cmd, info)
+        time.sleep(0.01)
+        self.assertNotEqual(first, func(cmd, info),
+                            'expired output was used')
+
+    def test_system_cache_failure(self):
+        calls = []
+
+        def run_command(cmd, docdir):
+            calls.append(cmd)
+            if len(calls) == 1:
+                raise OSError('temporary failure')
+            return b'output'
+
+        cache = templatefunctions.CommandCache()
+        original = templatefunctions.run_command
+        templatefunctions.run_command = run_command
+        try:
+            cache.prefetch(['cmd'], scriptdir)
+            future = cache._futures[('cmd', scriptdir)][0]
+            self.assertTrue(isinstance(future.exception(), OSError))
+            self.assertEqual(cache.output('cmd', scriptdir), b'output',
+                             'failed command was not executed again')
+            self.assertEqual(len(calls), 2)
+        finally:
+            templatefunctions.run_command = original
+
+    def test_prefetch(self):
+        info = {'docdir': scriptdir,
+                'system_cache': templatefunctions.CommandCache()}
+        cmds = ['sleep 0.5 && echo %d' % i for i in range(4)]
+        start = time.time()
+        templatefunctions.template_prefetch(*cmds, info=info)
+        outputs = [templatefunctions.template_system(cmd, info)
+                   for cmd in cmds]
+        self.assertEqual([o.strip() for o in outputs],
+                         [str(i).encode('ascii') for i in range(4)])
+        self.assertTrue(time.time() - start < 1.5,
+                        'prefetched commands were not run in parallel')
+
+    def test_include_context(self):
+        if not (_YAML and _JINJA2):
+            return
+        # Functions called after include() must resolve paths relative to
+        # the including document again
+        text = (u'...\n{{ include("dirA/a.txt") }}'
+                u'{{ filevars("dirA/a.txt").b }}')
+        rendered = drydoc.render_text(text, scriptdir + '/context.txt')
+        self.assertEqual(rendered, 'CONTENTCONTENTVAR')
+
+    def test_parallel_includes(self):
+        if not (_YAML and _JINJA2):
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # Distinct commands, so system() doesn't run them only once
+            for i in range(4):
+                text = u'...\n{%% set x = system("sleep 0.5; echo %d") %%}%d' \
+                    % (i, i)
+                drydoc.write_file(text, os.path.join(tmpdir, '%d.txt' % i))
+            text = u'...\n' + u''.join(u'{{ include("%d.txt") }}' % i
+                                       for i in range(4))
+            start = time.time()
+            rendered = drydoc.render_text(text, tmpdir + '/index.txt',
+                                          options={'parallel_includes': True})
+            self.assertEqual(rendered, '0123')
+            self.assertTrue(time.time() - start < 1.5,
+                            'included documents were not rendered in parallel')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_include_cycle(self):
+        if not (_YAML and _JINJA2):
+            return
+        tmpdir = tempfile.mkdtemp()
+        try:
+            a = os.path.join(tmpdir, 'a.txt')
+            b = os.path.join(tmpdir, 'b.txt')
+            drydoc.write_file(u'...\n{{ include("b.txt") }}', a)
+            drydoc.write_file(u'...\n{{ include("a.txt") }}', b)
+            with self.assertRaises(drydoc.IncludeError) as cm:
+                drydoc.render_text(drydoc.read_file(a), a)
+            self.assertEqual(str(cm.exception),
+                             'Include cycle: %s -> %s -> %s' % (a, b, a))
+
+            for i in range(3):
+                text = u'...\n{{ include("%d.txt") }}' % (i + 1)
+                drydoc.write_file(text, os.path.join(tmpdir, '%d.txt' % i))
+            drydoc.write_file(u'end', os.path.join(tmpdir, '3.txt'))
+            text = drydoc.read_file(os.path.join(tmpdir, '0.txt'))
+            rendered = drydoc.render_text(text, tmpdir + '/0.txt',
+                                          options={'max_include_depth': 3})
+            self.assertEqual(rendered, 'end')
+            self.assertRaises(drydoc.IncludeError, drydoc.render_text, text,
+                              tmpdir + '/0.txt',
+                              options={'max_include_depth': 2})
+            self.assertRaises(drydoc.RenderError, drydoc.render_text, text,
+                              tmpdir + '/0.txt', options={'dependencies': 1})
+
+            rendered = self.drydoc('include.txt --max-include-depth=0')
+            self.assertTrue(rendered.startswith(b'Invalid include depth'),
+                            'invalid include depth was accepted')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_render_async(self):
+        if not (_YAML and _JINJA2 and sys.version_info >= (3, 5)):
+            return
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            text = drydoc.read_file(scriptdir + '/filevars.txt')
+            renders = [drydoc.render_text_async(text, scriptdir + '/f.txt'),
+                       drydoc.render_text_async(
+                           u'...\n{{ include("include.txt") }}'
+                           u'{% set x = system("echo 1") %}{{ x[:1] }}',
+                           scriptdir + '/i.txt')]
+            rendered = loop.run_until_complete(asyncio.gather(*renders))
+            self.assertEqual(rendered, ['1VAR', 'CONTENTCONTENT' + str(b'1')])
+
+            doc = drydoc.DryDoc(correct_yaml_jinja)
+            rendered = loop.run_until_complete(doc.render_async())
+            self.assertEqual(rendered, correct_rendered)
+
+            # Empty template and output
+            for text in [u'a: 1\n...\n', u'a: 1\n...\n{{ "" }}\n']:
+                doc = drydoc.DryDoc(text)
+                self.assertEqual(doc.render(), u'')
+                rendered = loop.run_until_complete(doc.render_async())
+                self.assertEqual(rendered, u'')
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_stats(self):
+        if not (_YAML and _JINJA2):
+            return
+        import renderstats
+        drydoc.file_cache.clear()
+        stats = drydoc.stats = renderstats.Stats()
+        try:
+            filepath = scriptdir + '/filevars.txt'
+            text = drydoc.read_file(filepath)
+            drydoc.render_text(text, filepath)
+        finally:
+            drydoc.stats = None
+
+        document = stats.root.children[('document', filepath)]
+        render = document.children[('render', None)]
+        varspath = os.path.join(scriptdir, 'dirA', 'a.txt')
+        filevars = render.children[('filevars', varspath)]
+        self.assertEqual(filevars.calls, 2)
+        self.assertEqual(len(filevars.children), 1,
+                         'file was read more than once')
+        self.assertTrue(document.elapsed >= render.elapsed >= 0)
+        self.assertTrue(any(line.endswith('    filevars ' + varspath)
+                            for line in stats.format()))
+
     def test_specialcharpaths(self):
         rendered = self.drydoc('specialcharpaths/specialpath.txt')
         compare = b'12' if _PY3 else '12'
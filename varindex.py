@@ -0,0 +1,166 @@
+"""
+Prebuilt index of variables of DRY documents in directory trees.
+filevars() reads variables from the index instead of parsing the document,
+as long as the document's modification time and size match the ones in the
+index. Building the index again parses only documents which have changed
+since it was last built.
+
+Index is a pickle file, so only use indexes you have built yourself.
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+
+import drydoc
+
+# Loaded indexes by path, with fingerprints of the index files
+_indexes = {}
+_lock = threading.Lock()
+
+
+class VariableIndex(object):
+    """Variables of documents by absolute path. entries is dict of path:
+    (fingerprint, variables) and roots lists the files and directories the
+    index covers. version identifies the engine which parsed the variables.
+    """
+
+    def __init__(self, version, encoding=drydoc.default_encoding):
+        self.version = version
+        self.encoding = encoding
+        self.roots = []
+        self.entries = {}
+
+    def get(self, filepath, fingerprint, encoding):
+        """Returns variables of document in filepath as AttributeDict, or
+        None if the document is not indexed or has changed.
+        """
+        if encoding != self.encoding:
+            return None
+        entry = self.entries.get(filepath)
+        if entry is None or entry[0] != fingerprint:
+            return None
+        return drydoc.AttributeDict(entry[1])
+
+    def refresh(self, paths=()):
+        """Adds files and directories in paths to the index and updates it.
+        Documents which have changed are parsed again and removed documents
+        are dropped. Files which can't be read or parsed are not indexed.
+        Returns number of parsed documents.
+        """
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in self.roots:
+                self.roots.append(path)
+
+        entries = {}
+        parsed = 0
+        for filepath in _walk(self.roots):
+            try:
+                fingerprint = drydoc.file_fingerprint(filepath)
+            except OSError:
+                continue
+
+            entry = self.entries.get(filepath)
+            if entry is None or entry[0] != fingerprint:
+                try:
+                    variables = drydoc.read_variables(
+                        filepath, encoding=self.encoding)
+                except Exception:
+                    continue
+                entry = (fingerprint, dict(variables))
+                parsed += 1
+            entries[filepath] = entry
+
+        self.entries = entries
+        return parsed
+
+    def save(self, path):
+        """Writes the index to path. Readers never see a partial index."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmppath, path)
+
+
+def _walk(paths):
+    """Yields absolute paths of files in paths. Directories are walked
+    recursively, hidden files are skipped.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            if os.path.isfile(path):
+                yield path
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(names):
+                if not name.startswith('.'):
+                    yield os.path.join(root, name)
+
+
+def load(path):
+    """Returns VariableIndex in path. Raises IOError if the file can't be
+    read and ValueError if it isn't an index.
+    """
+    with open(path, 'rb') as f:
+        try:
+            index = pickle.load(f)
+        except Exception as e:
+            raise ValueError('Invalid variable index %s: %s' % (path, e))
+    if not isinstance(index, VariableIndex):
+        raise ValueError('Invalid variable index %s' % path)
+    return index
+
+
+def build(path, paths=(), encoding=drydoc.default_encoding):
+    """Builds index of documents in paths to file in path, or refreshes the
+    existing index. Indexes of other encodings and engine versions are
+    built from scratch. Returns (VariableIndex, number of parsed documents).
+    """
+    version = drydoc.engine_version()
+    try:
+        index = load(path)
+    except (IOError, OSError, ValueError):
+        index = None
+    if index is None or index.version != version or \
+       index.encoding != encoding:
+        roots = index.roots if index is not None else []
+        index = VariableIndex(version, encoding)
+        index.roots = roots
+
+    parsed = index.refresh(paths)
+    index.save(path)
+    return index, parsed
+
+
+def get_index(path):
+    """Returns index in path for filevars(), or None if it can't be loaded
+    or was built with another engine. The index is loaded again when the
+    file changes.
+    """
+    path = os.path.abspath(path)
+    try:
+        fingerprint = drydoc.file_fingerprint(path)
+    except OSError:
+        return None
+
+    with _lock:
+        loaded = _indexes.get(path)
+        if loaded is not None and loaded[0] == fingerprint:
+            return loaded[1]
+
+    try:
+        index = load(path)
+    except (IOError, OSError, ValueError):
+        index = None
+    if index is not None and index.version != drydoc.engine_version():
+        index = None
+
+    with _lock:
+        _indexes[path] = (fingerprint, index)
+    return index
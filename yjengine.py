@@ -0,0 +1,173 @@
+"""
+YAML-Jinja2 engine. Variables are parsed with PyYAML and templates are
+rendered with Jinja2. This module is imported only when the engine is used
+for the first time, because importing both libraries is slow.
+"""
+
+import os
+
+import jinja2
+import yaml
+
+import drydoc
+
+# Use the C implementation of the safe loader when PyYAML is built with
+# libyaml, it's many times faster than the pure Python one.
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+def load_yaml(text):
+    return yaml.load(text, Loader=YamlLoader)
+
+
+# This class fixes the issue when trailing newline is removed, when it
+# shouldn't be.
+class FixedJinja2Template(jinja2.Template):
+    def __new__(cls, text):
+        t = super(FixedJinja2Template, cls).__new__(cls, text)
+        t.text = text
+        return t
+
+    def render(self, **kwargs):
+        rendered = super(FixedJinja2Template, self).render(**kwargs)
+        if self.text.endswith('\n') and not rendered.endswith('\n'):
+            rendered += '\n'
+        return rendered
+
+    def generate(self, **kwargs):
+        last = ''
+        for chunk in super(FixedJinja2Template, self).generate(**kwargs):
+            if chunk:
+                last = chunk
+                yield chunk
+        if self.text.endswith('\n') and not last.endswith('\n'):
+            yield '\n'
+
+
+# Environment variable which sets the directory of compiled template
+# bytecode. Jinja2's default directory in temp directory is used if it's
+# not set. Environment variable is used, so that worker processes get the
+# same setting.
+bytecode_cache_env = 'DRYDOC_BYTECODE_CACHE'
+
+_environment = None
+
+
+def create_environment(template_class=FixedJinja2Template, **kwargs):
+    """Returns new Jinja2 environment which uses the bytecode cache.
+    kwargs are passed to jinja2.Environment.
+    """
+    try:
+        directory = os.environ.get(bytecode_cache_env) or None
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+    except (OSError, RuntimeError):
+        # Cache directory is not usable, templates are compiled always
+        bytecode_cache = None
+
+    environment = jinja2.Environment(bytecode_cache=bytecode_cache, **kwargs)
+    environment.template_class = template_class
+    return environment
+
+
+def get_environment():
+    """Returns the Jinja2 environment shared by all templates."""
+    global _environment
+    if _environment is None:
+        _environment = create_environment()
+    return _environment
+
+
+def compile_template(text, environment=None):
+    """Returns FixedJinja2Template compiled from text. Template is loaded
+    through a loader, because Jinja2 uses bytecode cache only for templates
+    which come from loaders. Template is named by hash of its source, so
+    bytecode is shared by all templates with the same source.
+    Templates are compiled in the shared environment by default.
+    """
+    if environment is None:
+        environment = get_environment()
+    name = drydoc.hash_text(text)
+    if environment.is_async:
+        # Async templates compile to different code, keep their bytecode
+        # apart from the synchronous ones
+        name = 'async-' + name
+    loader = jinja2.FunctionLoader(lambda name: text)
+    t = loader.load(environment, name)
+    t.text = text
+    return t
+
+
+# Arguments of template functions which read files
+_file_functions = {'include': ('path', 'render'), 'filevars': ('path',)}
+
+
+def find_file_calls(text):
+    """Returns list of (function name, path, render) tuples of include()
+    and filevars() calls in template text. render is True for filevars().
+    Only calls with constant arguments are returned, because other
+    arguments are known only while rendering.
+    """
+    try:
+        ast = get_environment().parse(text)
+    except jinja2.TemplateSyntaxError:
+        # Error is reported when the template is rendered
+        return []
+
+    calls = []
+    for call in ast.find_all(jinja2.nodes.Call):
+        if not isinstance(call.node, jinja2.nodes.Name) or \
+           call.node.name not in _file_functions or \
+           call.dyn_args or call.dyn_kwargs:
+            continue
+
+        argnames = _file_functions[call.node.name]
+        args = dict(zip(argnames, call.args))
+        args.update((kw.key, kw.value) for kw in call.kwargs)
+        if len(call.args) > len(argnames) or set(args) - set(argnames) or \
+           not all(isinstance(v, jinja2.nodes.Const) for v in args.values()):
+            continue
+
+        path = args['path'].value if 'path' in args else None
+        render = args['render'].value if 'render' in args else True
+        if isinstance(path, (type(u''), type(''))):
+            calls.append((call.node.name, path, render))
+    return calls
+
+
+def find_includes(text):
+    """Returns list of (path, render) tuples of include() calls with
+    constant arguments in template text.
+    """
+    return [(path, render) for name, path, render in find_file_calls(text)
+            if name == 'include']
+
+
+def version():
+    """Returns versions of the libraries used by the engine."""
+    return 'jinja2 %s, yaml %s (%s)' % (jinja2.__version__, yaml.__version__,
+                                        YamlLoader.__name__)
+
+
+def diagnostics():
+    """Returns list of lines describing how the engine is set up."""
+    libyaml = 'libyaml' if YamlLoader.__name__.startswith('C') \
+        else 'pure Python'
+    bytecode_cache = get_environment().bytecode_cache
+    if bytecode_cache is None:
+        bytecode_cache_dir = 'disabled'
+    else:
+        bytecode_cache_dir = bytecode_cache.directory
+    return ['Libraries: jinja2 %s, yaml %s' % (jinja2.__version__,
+                                                yaml.__version__),
+            'YAML loader: %s (%s)' % (YamlLoader.__name__, libyaml),
+            'Bytecode cache: %s' % bytecode_cache_dir]
+
+
+yaml_engine = (load_yaml, ())
+jinja_engine = (compile_template, ())
+engine = (yaml_engine, jinja_engine)